@@ -1,52 +1,2148 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory
-from datetime import datetime, date
+from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory, send_file, abort, g, jsonify, Response, stream_with_context
+from datetime import datetime, date, timedelta
+from decimal import Decimal, InvalidOperation
 import mysql.connector
-from werkzeug.security import generate_password_hash, check_password_hash
+from mysql.connector import errorcode
+from collections import OrderedDict, deque
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join, DEFAULT_PBKDF2_ITERATIONS
 from werkzeug.utils import secure_filename
+import atexit
+import base64
+import hashlib
+import click
+import csv
+import gzip
+import heapq
+import io
+import json
+import mimetypes
+import multiprocessing
 import os
+import pickle
+import posixpath
+import queue
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import quote
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'
 app.config['UPLOAD_FOLDER'] = os.path.join('static', 'uploads', 'documents')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max limit
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))  # bytes copied per read while storing an upload
+app.config['BLOB_GC_GRACE'] = int(os.environ.get('BLOB_GC_GRACE', 3600))  # seconds before an unreferenced file on disk counts as orphaned
+app.config['DOCUMENT_SENDFILE'] = os.environ.get('DOCUMENT_SENDFILE', '')  # '', 'x-sendfile' (Apache/lighttpd) or 'x-accel-redirect' (nginx)
+app.config['DOCUMENT_ACCEL_PREFIX'] = os.environ.get('DOCUMENT_ACCEL_PREFIX', '/protected-documents/')  # internal nginx location aliased to UPLOAD_FOLDER
+app.config['DOCUMENT_META_TTL'] = int(os.environ.get('DOCUMENT_META_TTL', 300))  # seconds; deletes invalidate it immediately
+app.config['DOCUMENT_PREVIEW_WORKERS'] = int(os.environ.get('DOCUMENT_PREVIEW_WORKERS', 2))
+app.config['DOCUMENT_TEXT_MAX_CHARS'] = int(os.environ.get('DOCUMENT_TEXT_MAX_CHARS', 200000))  # extracted text kept per document
+app.config['DOCUMENT_THUMBNAIL_SIZE'] = int(os.environ.get('DOCUMENT_THUMBNAIL_SIZE', 240))  # longest edge of a thumbnail, in pixels
+app.config['SEARCH_MAX_RESULTS'] = int(os.environ.get('SEARCH_MAX_RESULTS', 500))  # deepest hit reachable by paging /admin/search
 
-# Database connection function
-def get_db_connection():
-    return mysql.connector.connect(
-        host="localhost",
-        user="root",
-        password="",  # Update with your MySQL password
-        database="hrms"
-    )
+# Database settings (override through environment variables in production)
+app.config['DB_HOST'] = os.environ.get('DB_HOST', 'localhost')
+app.config['DB_USER'] = os.environ.get('DB_USER', 'root')
+app.config['DB_PASSWORD'] = os.environ.get('DB_PASSWORD', '')  # Update with your MySQL password
+app.config['DB_NAME'] = os.environ.get('DB_NAME', 'hrms')
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))  # connections per worker process
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 5))  # seconds to wait for a free connection
+app.config['DB_POOL_PING_AFTER'] = float(os.environ.get('DB_POOL_PING_AFTER', 30))  # re-check connections idle longer than this
+
+# Cache settings: in-process by default, shared across workers when CACHE_URL points at Redis
+app.config['CACHE_URL'] = os.environ.get('CACHE_URL')
+app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+app.config['NOTIFICATION_COUNT_TTL'] = int(os.environ.get('NOTIFICATION_COUNT_TTL', 300))
+app.config['DASHBOARD_STATS_TTL'] = int(os.environ.get('DASHBOARD_STATS_TTL', 30))
+app.config['DEPARTMENT_STATS_TTL'] = int(os.environ.get('DEPARTMENT_STATS_TTL', 600))
+app.config['BULK_CHUNK_SIZE'] = int(os.environ.get('BULK_CHUNK_SIZE', 1000))  # rows per multi-row statement
+app.config['PAGE_SIZE'] = int(os.environ.get('PAGE_SIZE', 50))  # default rows per listing page
+app.config['MAX_PAGE_SIZE'] = int(os.environ.get('MAX_PAGE_SIZE', 200))
+app.config['EXPORT_FETCH_SIZE'] = int(os.environ.get('EXPORT_FETCH_SIZE', 2000))  # rows fetched per round trip when exporting
+
+# Sessions: the cookie only carries a random session id, the data lives server-side.
+# 'sqlite' keeps it in a local file per host, 'cache' in the shared cache (use with CACHE_URL
+# when running several hosts), 'cookie' falls back to Flask's signed cookie sessions.
+app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'sqlite')
+app.config['SESSION_DB_PATH'] = os.environ.get('SESSION_DB_PATH', os.path.join(app.instance_path, 'sessions.db'))
+app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get('IDENTITY_CACHE_TTL', 60))  # seconds; edits invalidate it immediately
+
+# Password hashing: method and cost are tunable, and stored hashes made with any other
+# method are upgraded the next time their owner logs in
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 4))  # hashes computed at once per worker process
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 16))  # extra logins allowed to wait for a hash worker
+app.config['PASSWORD_HASH_WAIT'] = float(os.environ.get('PASSWORD_HASH_WAIT', 2))  # seconds to wait for a slot before giving up
+
+# Login throttling: failed attempts are counted per client IP and per account and IP, so
+# a stranger's bad guesses can't lock someone else out of their account
+app.config['LOGIN_THROTTLE_WINDOW'] = int(os.environ.get('LOGIN_THROTTLE_WINDOW', 900))  # seconds
+app.config['LOGIN_MAX_FAILURES_PER_IP'] = int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP', 50))
+app.config['LOGIN_MAX_FAILURES_PER_ACCOUNT'] = int(os.environ.get('LOGIN_MAX_FAILURES_PER_ACCOUNT', 5))
+
+# Number of reverse proxies in front of the app. When set, the client address used for
+# throttling and the audit log is read from X-Forwarded-For instead of the proxy's own
+# address; leave it at 0 when clients connect directly, or the header can be spoofed.
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+
+# Background report jobs: files are built by a process pool and cached on disk
+app.config['REPORT_FOLDER'] = os.environ.get('REPORT_FOLDER', os.path.join(app.instance_path, 'reports'))
+app.config['REPORT_WORKERS'] = int(os.environ.get('REPORT_WORKERS', 2))
+app.config['REPORT_CACHE_MAX_AGE'] = int(os.environ.get('REPORT_CACHE_MAX_AGE', 7 * 24 * 3600))  # seconds
+app.config['REPORT_JOB_STALE_AFTER'] = int(os.environ.get('REPORT_JOB_STALE_AFTER', 600))  # seconds without progress
+
+# Payroll run: allowances are a share of the basic salary; absences and unpaid leave
+# are deducted pro rata over the working (Mon-Fri) days of the month
+app.config['PAYROLL_ALLOWANCE_RATE'] = Decimal(os.environ.get('PAYROLL_ALLOWANCE_RATE', '0'))
+app.config['PAYROLL_UNPAID_LEAVE_TYPES'] = os.environ.get('PAYROLL_UNPAID_LEAVE_TYPES', 'unpaid').split(',')
+
+# Audit log writer: events are queued in memory and written in multi-row batches
+app.config['AUDIT_BATCH_SIZE'] = int(os.environ.get('AUDIT_BATCH_SIZE', 200))
+app.config['AUDIT_FLUSH_INTERVAL'] = float(os.environ.get('AUDIT_FLUSH_INTERVAL', 1.0))  # seconds
+app.config['AUDIT_QUEUE_SIZE'] = int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+app.config['AUDIT_OVERFLOW'] = os.environ.get('AUDIT_OVERFLOW', 'block')  # 'block' (briefly) or 'drop' when the queue is full
+app.config['AUDIT_BLOCK_TIMEOUT'] = float(os.environ.get('AUDIT_BLOCK_TIMEOUT', 0.5))
+app.config['AUDIT_RETENTION_MONTHS'] = int(os.environ.get('AUDIT_RETENTION_MONTHS', 3))  # months kept in audit_logs, counting the current one
+app.config['AUDIT_ARCHIVE_FOLDER'] = os.environ.get('AUDIT_ARCHIVE_FOLDER', os.path.join(app.instance_path, 'audit_archive'))
+
+# ========== DATABASE POOL ==========
+
+# Fixed-size pool of MySQL connections shared by all threads of one worker process.
+# Connections are opened lazily, so nothing is shared across gunicorn forks.
+class ConnectionPool:
+    def __init__(self, size, timeout, ping_after, **connect_args):
+        self.size = size
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.connect_args = connect_args
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        # Signalled whenever a connection goes back to the pool or a slot is freed
+        self._cond = threading.Condition(self._lock)
+        self._open = 0
+        self._in_use = 0
+        self.stats = {'checkouts': 0, 'waits': 0, 'timeouts': 0, 'connects': 0, 'reconnects': 0, 'discarded': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _connect(self):
+        try:
+            conn = mysql.connector.connect(**self.connect_args)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        self._count('connects')
+        return conn
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        conn = None
+        with self._cond:
+            while conn is None:
+                try:
+                    conn, idle_since = self._idle.get_nowait()
+                    break
+                except queue.Empty:
+                    pass
+                if self._open < self.size:
+                    self._open += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise mysql.connector.errors.PoolError(
+                        f"No database connection available within {self.timeout}s (pool size {self.size})")
+                if not waited:
+                    self.stats['waits'] += 1
+                    waited = True
+                self._cond.wait(remaining)
+        if conn is None:
+            conn, idle_since = self._connect(), time.monotonic()
+
+        # Health check: only ping connections that sat idle long enough to have been dropped by the server
+        if time.monotonic() - idle_since > self.ping_after and not conn.is_connected():
+            try:
+                conn.reconnect(attempts=2, delay=0)
+            except mysql.connector.Error:
+                self._discard(conn)
+                raise
+            self._count('reconnects')
+
+        with self._lock:
+            self.stats['checkouts'] += 1
+            self._in_use += 1
+        return conn
+
+    def release(self, conn):
+        with self._lock:
+            self._in_use -= 1
+        try:
+            # Never hand an open transaction to the next request
+            if conn.in_transaction:
+                conn.rollback()
+        except mysql.connector.Error:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.put((conn, time.monotonic()))
+            self._cond.notify()
+
+    # Give back a checked-out connection that must not be reused
+    def discard(self, conn):
+        with self._lock:
+            self._in_use -= 1
+        self._discard(conn)
+
+    # Close a broken connection and free its slot for a waiting acquire()
+    def _discard(self, conn):
+        with self._cond:
+            self._open -= 1
+            self.stats['discarded'] += 1
+            self._cond.notify()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, size=self.size, open=self._open, in_use=self._in_use, idle=self._idle.qsize())
+
+db_pool = ConnectionPool(
+    size=app.config['DB_POOL_SIZE'],
+    timeout=app.config['DB_POOL_TIMEOUT'],
+    ping_after=app.config['DB_POOL_PING_AFTER'],
+    host=app.config['DB_HOST'],
+    user=app.config['DB_USER'],
+    password=app.config['DB_PASSWORD'],
+    database=app.config['DB_NAME']
+)
+
+# Request-scoped connection: checked out on first use, returned to the pool on teardown
+def get_db():
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+# ========== CACHE ==========
+
+# In-process LRU cache with per-key TTL. Each worker keeps its own copy, so
+# values may lag behind other workers by at most their TTL.
+class LocalCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    # Increment an existing counter; missing keys stay missing so the next read reloads them,
+    # unless a ttl is given, in which case a missing counter starts at `amount`
+    def incr(self, key, amount=1, ttl=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if ttl is None:
+                    return None
+                item = (time.monotonic() + ttl, 0)
+            self._data[key] = (item[0], item[1] + amount)
+            return item[1] + amount
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+# Shared backend with the same interface, used when CACHE_URL is configured
+class RedisCache:
+    # INCRBY only if the key exists, keeping LocalCache.incr semantics in one atomic step
+    INCR_EXISTING = """
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            return redis.call('INCRBY', KEYS[1], ARGV[1])
+        end
+        return false
+    """
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self._incr_existing = self.client.register_script(self.INCR_EXISTING)
+
+    # Integers are stored as plain Redis integers so incr() can use INCRBY on them
+    def get(self, key):
+        value = self.client.get(key)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            return pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        if type(value) is not int:
+            value = pickle.dumps(value)
+        self.client.set(key, value, ex=max(1, int(ttl)))
+
+    def incr(self, key, amount=1, ttl=None):
+        if ttl is None:
+            return self._incr_existing(keys=[key], args=[amount])
+        # The window starts at the first increment; later ones leave the expiry alone
+        pipe = self.client.pipeline()
+        pipe.incrby(key, amount)
+        pipe.expire(key, max(1, int(ttl)), nx=True)
+        return pipe.execute()[0]
+
+    def delete(self, key):
+        self.client.delete(key)
+
+if app.config['CACHE_URL']:
+    cache = RedisCache(app.config['CACHE_URL'])
+else:
+    cache = LocalCache(app.config['CACHE_MAX_ENTRIES'])
+
+# ========== SESSIONS ==========
+
+# Session data kept in a local SQLite file, one connection per thread
+class SQLiteSessionStore:
+    PURGE_INTERVAL = 300  # seconds between sweeps of expired sessions
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._last_purge = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)
+            """)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def load(self, sid):
+        row = self._conn().execute("SELECT data FROM sessions WHERE sid = ? AND expires_at > ?",
+                                   (sid, time.time())).fetchone()
+        return row[0] if row else None
+
+    def save(self, sid, data, ttl):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO sessions (sid, data, expires_at) VALUES (?, ?, ?)", (sid, data, now + ttl))
+        if now - self._last_purge > self.PURGE_INTERVAL:
+            self._last_purge = now
+            conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+
+    def delete(self, sid):
+        self._conn().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+# Session data kept in the application cache (shared between hosts when CACHE_URL is Redis)
+class CacheSessionStore:
+    def load(self, sid):
+        return cache.get(f"session:{sid}")
+
+    def save(self, sid, data, ttl):
+        cache.set(f"session:{sid}", data, ttl)
+
+    def delete(self, sid):
+        cache.delete(f"session:{sid}")
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.new = new
+        self.modified = False
+        self.retired_sids = []
+
+    # Clearing (logout, login) also moves to a fresh id so an old cookie is worthless
+    def clear(self):
+        super().clear()
+        if not self.new:
+            self.retired_sids.append(self.sid)
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+
+class ServerSideSessionInterface(SessionInterface):
+    serializer = session_json_serializer
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.load(sid)
+            if data is not None:
+                try:
+                    return ServerSideSession(self.serializer.loads(data), sid=sid)
+                except ValueError:
+                    pass
+        return ServerSideSession(new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        for sid in session.retired_sids:
+            self.store.delete(sid)
+
+        if not session:
+            if session.retired_sids:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+
+        self.store.save(session.sid, self.serializer.dumps(dict(session)),
+                        app.permanent_session_lifetime.total_seconds())
+        response.vary.add('Cookie')
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+if app.config['SESSION_BACKEND'] == 'sqlite':
+    app.session_interface = ServerSideSessionInterface(SQLiteSessionStore(app.config['SESSION_DB_PATH']))
+elif app.config['SESSION_BACKEND'] == 'cache':
+    app.session_interface = ServerSideSessionInterface(CacheSessionStore())
+
+# ========== IDENTITY CACHE ==========
+
+# Session keys that mirror the user's account and employee record
+IDENTITY_SESSION_KEYS = {'user_name': 'name', 'user_email': 'email', 'role': 'role'}
+EMPLOYEE_SESSION_KEYS = {'emp_id': 'emp_id', 'dept_id': 'department_id', 'position': 'position'}
+
+# Role, department and position of a user, cached per user. Writes that change them call
+# invalidate_identity(), so route checks that read the session never act on a transfer
+# or deletion made after login (other workers may lag by IDENTITY_CACHE_TTL unless the
+# cache is shared).
+def get_identity(user_id):
+    key = f"identity:{user_id}"
+    identity = cache.get(key)
+    if identity is None:
+        cursor = get_db().cursor(dictionary=True)
+        cursor.execute("""
+            SELECT u.id, u.name, u.email, u.role,
+                   e.id as emp_id, e.department_id, e.position
+            FROM users u
+            LEFT JOIN employees e ON e.user_id = u.id
+            WHERE u.id = %s
+        """, (user_id,))
+        identity = cursor.fetchone() or {}
+        cache.set(key, identity, app.config['IDENTITY_CACHE_TTL'])
+    return identity or None
+
+def invalidate_identity(*user_ids):
+    for user_id in user_ids:
+        if user_id:
+            cache.delete(f"identity:{user_id}")
+
+# Uploaded documents live under static/ for historical reasons; they are only served
+# through download_document, which checks permissions.
+@app.before_request
+def block_static_uploads():
+    if request.endpoint == 'static':
+        filename = posixpath.normpath(request.view_args.get('filename', ''))
+        if filename == 'uploads' or filename.startswith('uploads/'):
+            abort(404)
+
+# Keep the identity fields of the session in step with the database. The session is
+# only written when something actually changed.
+@app.before_request
+def refresh_identity():
+    if 'user_id' not in session or request.endpoint == 'static':
+        return
+    identity = get_identity(session['user_id'])
+    if identity is None:
+        # The account was deleted while logged in
+        session.clear()
+        return
+
+    keys = dict(IDENTITY_SESSION_KEYS)
+    if identity['emp_id']:
+        keys.update(EMPLOYEE_SESSION_KEYS)
+    else:
+        for session_key in EMPLOYEE_SESSION_KEYS:
+            session.pop(session_key, None)
+    for session_key, column in keys.items():
+        if session.get(session_key) != identity[column]:
+            session[session_key] = identity[column]
+
+# ========== NOTIFICATION COUNTS ==========
+
+def get_notification_count(user_id):
+    key = f"notifications:unread:{user_id}"
+    count = cache.get(key)
+    if count is None:
+        cursor = get_db().cursor(dictionary=True)
+        cursor.execute("SELECT COUNT(*) as count FROM notifications WHERE user_id = %s AND is_read = 0", (user_id,))
+        result = cursor.fetchone()
+        count = result['count'] if result else 0
+        cache.set(key, count, app.config['NOTIFICATION_COUNT_TTL'])
+    return count
+
+# Several notifications as one multi-row INSERT on the caller's cursor. The cached
+# unread counters are left alone; call invalidate_notification_counts() after commit.
+def notify_many(cursor, notifications):
+    cursor.executemany("INSERT INTO notifications (user_id, message) VALUES (%s, %s)", notifications)
+
+# Drop the cached unread counters so the next read recounts the committed rows
+def invalidate_notification_counts(*user_ids):
+    for user_id in set(user_ids):
+        cache.delete(f"notifications:unread:{user_id}")
+
+def reset_notification_count(user_id):
+    cache.set(f"notifications:unread:{user_id}", 0, app.config['NOTIFICATION_COUNT_TTL'])
+
+# ========== DATA VERSIONS ==========
+
+# Bump the change counter of each table a write touched. Call it right before commit
+# so the counter row is locked for as short a time as possible.
+def bump_data_version(cursor, *names):
+    cursor.executemany("""
+        INSERT INTO data_versions (name, version) VALUES (%s, 1)
+        ON DUPLICATE KEY UPDATE version = version + 1
+    """, [(name,) for name in names])
+
+def get_data_versions(cursor, names):
+    cursor.execute(f"SELECT name, version FROM data_versions WHERE name IN ({', '.join(['%s'] * len(names))})", list(names))
+    versions = dict(cursor.fetchall())
+    return {name: versions.get(name, 0) for name in names}
+
+# ========== DEPARTMENT STATS ==========
+
+# Headcount per department (keyed by department_id, None for unassigned) from one grouped
+# scan of employees. Cached until an employee is added, moved or removed; pass fresh=True
+# where acting on a stale number would be unsafe.
+def get_department_headcounts(fresh=False):
+    key = 'departments:headcounts'
+    headcounts = None if fresh else cache.get(key)
+    if headcounts is not None:
+        return headcounts
+
+    cursor = get_db().cursor(dictionary=True)
+    cursor.execute("""
+        SELECT department_id, COUNT(*) as total,
+               COUNT(CASE WHEN role = 'employee' THEN 1 END) as employees,
+               COUNT(CASE WHEN role = 'hr' THEN 1 END) as hr
+        FROM employees
+        GROUP BY department_id
+    """)
+    headcounts = {row['department_id']: {'total': row['total'], 'employees': row['employees'], 'hr': row['hr']}
+                  for row in cursor.fetchall()}
+    cache.set(key, headcounts, app.config['DEPARTMENT_STATS_TTL'])
+    return headcounts
+
+def department_headcount(dept_id, role='total', fresh=False):
+    return get_department_headcounts(fresh).get(dept_id, {}).get(role, 0)
+
+def company_headcount(role='total'):
+    return sum(counts[role] for counts in get_department_headcounts().values())
+
+# ========== DASHBOARD STATS ==========
+
+# All dashboard counters for one scope (dept_id=None means company-wide) in a single round trip
+def get_dashboard_stats(dept_id=None):
+    key = f"dashboard:stats:{'all' if dept_id is None else dept_id}"
+    stats = cache.get(key)
+    if stats is not None:
+        return stats
+
+    # Headcounts come from the department stats cache rather than another employees scan
+    cursor = get_db().cursor(dictionary=True)
+    if dept_id is None:
+        cursor.execute("""
+            SELECT
+                (SELECT COUNT(*) FROM departments) as total_departments,
+                (SELECT COUNT(*) FROM attendance WHERE date = CURDATE()) as today_attendance,
+                (SELECT COUNT(*) FROM leave_requests WHERE status = 'pending') as pending_leaves
+        """)
+        stats = cursor.fetchone()
+        stats['total_employees'] = company_headcount('employees')
+        stats['total_hr'] = company_headcount('hr')
+    else:
+        cursor.execute("""
+            SELECT
+                (SELECT COUNT(*) FROM attendance a
+                 JOIN employees e ON a.employee_id = e.id
+                 WHERE a.date = CURDATE() AND e.department_id = %s) as today_attendance,
+                (SELECT COUNT(*) FROM leave_requests lr
+                 JOIN employees e ON lr.employee_id = e.id
+                 WHERE lr.status = 'pending' AND e.department_id = %s) as pending_leaves
+        """, (dept_id, dept_id))
+        stats = cursor.fetchone()
+        stats['dept_employees'] = department_headcount(dept_id, 'employees')
+    cache.set(key, stats, app.config['DASHBOARD_STATS_TTL'])
+    return stats
+
+# Call after any employee insert, delete or department transfer; dashboard counters
+# built from the headcounts have to go with them
+def invalidate_department_headcounts():
+    cache.delete('departments:headcounts')
+
+# Drop cached counters after a write that changes them
+def invalidate_dashboard_stats(*dept_ids):
+    cache.delete('dashboard:stats:all')
+    for dept_id in dept_ids:
+        if dept_id:
+            cache.delete(f"dashboard:stats:{dept_id}")
+
+# ========== ATTENDANCE WRITES ==========
+
+# Both helpers are single statements against uq_attendance_employee_date, so concurrent
+# or repeated submissions for the same employee and day can never create a second row.
+
+# Create or overwrite the day's record; returns the resulting row
+def upsert_attendance(cursor, employee_id, att_date, check_in, check_out, status):
+    cursor.execute("""
+        INSERT INTO attendance (employee_id, date, check_in, check_out, status)
+        VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id),
+            check_in = VALUES(check_in), check_out = VALUES(check_out), status = VALUES(status)
+    """, (employee_id, att_date, check_in, check_out, status))
+    return {
+        'id': cursor.lastrowid,
+        'employee_id': employee_id,
+        'date': att_date,
+        'check_in': check_in,
+        'check_out': check_out,
+        'status': status,
+        'created': cursor.rowcount == 1
+    }
+
+# Self check-in: only fills check_in if the day has none yet. Returns False if already checked in.
+def check_in_attendance(cursor, employee_id, att_date, check_in):
+    cursor.execute("""
+        INSERT INTO attendance (employee_id, date, check_in, status)
+        VALUES (%s, %s, %s, 'present')
+        ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id),
+            status = IF(check_in IS NULL, 'present', status),
+            check_in = COALESCE(check_in, VALUES(check_in))
+    """, (employee_id, att_date, check_in))
+    return cursor.rowcount > 0
+
+# Self check-out: closes today's open record. Returns False if there was nothing to close.
+def check_out_attendance(cursor, employee_id, att_date, check_out):
+    cursor.execute("""
+        UPDATE attendance
+        SET check_out = %s
+        WHERE employee_id = %s AND date = %s AND check_in IS NOT NULL AND check_out IS NULL
+    """, (check_out, employee_id, att_date))
+    return cursor.rowcount > 0
+
+ATTENDANCE_STATUSES = ('present', 'absent', 'half_day', 'leave')
+
+# Accept both the enum values and the labels used by the forms ('Half Day', 'Present', ...)
+def normalize_attendance_status(status):
+    status = (status or '').strip().lower().replace(' ', '_')
+    return 'leave' if status == 'on_leave' else status
+
+# ========== BULK ATTENDANCE IMPORT ==========
+
+UPSERT_ATTENDANCE_SQL = """
+    INSERT INTO attendance (employee_id, date, check_in, check_out, status)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        check_in = VALUES(check_in), check_out = VALUES(check_out), status = VALUES(status)
+"""
+
+# Yield (line_number, record_dict) from a binary CSV or JSONL stream without loading it all
+def read_import_records(stream, fmt):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'jsonl':
+        for line_no, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_no, record
+    else:
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record
+
+def import_format(filename):
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+# Flash the outcome of a bulk import: the summary, then the first few skipped rows
+def flash_import_report(report, summary, shown_errors=10):
+    flash(f"{summary} in {report['seconds']}s ({report['rows_per_second']} rows/s).", 'success')
+    errors = report['errors']
+    if errors:
+        shown = '; '.join(f"line {e['line']}: {e['error']}" for e in errors[:shown_errors])
+        more = f" (+{len(errors) - shown_errors} more)" if len(errors) > shown_errors else ''
+        flash(f"{len(errors)} rows skipped - {shown}{more}", 'warning')
+
+def parse_time_field(value):
+    value = (value or '').strip()
+    if not value:
+        return None
+    for fmt in ('%H:%M:%S', '%H:%M'):
+        try:
+            return datetime.strptime(value, fmt).time()
+        except ValueError:
+            pass
+    raise ValueError(f"invalid time '{value}'")
+
+def parse_attendance_record(record, allowed_ids):
+    if not isinstance(record, dict):
+        raise ValueError("malformed row")
+    try:
+        employee_id = int(record.get('employee_id'))
+    except (TypeError, ValueError):
+        raise ValueError("missing or invalid employee_id")
+    if employee_id not in allowed_ids:
+        raise ValueError(f"employee {employee_id} not found in your department")
+    try:
+        att_date = date.fromisoformat(str(record.get('date', '')).strip())
+    except ValueError:
+        raise ValueError("missing or invalid date (expected YYYY-MM-DD)")
+    check_in = parse_time_field(record.get('check_in'))
+    check_out = parse_time_field(record.get('check_out'))
+    status = normalize_attendance_status(record.get('status')) or ('present' if check_in else 'absent')
+    if status not in ATTENDANCE_STATUSES:
+        raise ValueError(f"invalid status '{record.get('status')}'")
+    return (employee_id, att_date, check_in, check_out, status)
+
+# Stream an attendance file into the database in chunks of multi-row upserts.
+# The whole import is one transaction: rows that fail validation are reported and
+# skipped, while a database error rolls everything back. scoped only accepts employees
+# of dept_id, so a NULL dept_id accepts nobody.
+def import_attendance(conn, stream, fmt, scoped=False, dept_id=None, chunk_size=None):
+    chunk_size = chunk_size or app.config['BULK_CHUNK_SIZE']
+    started = time.monotonic()
+    cursor = conn.cursor()
+
+    if scoped:
+        cursor.execute("SELECT id FROM employees WHERE department_id = %s", (dept_id,))
+    else:
+        cursor.execute("SELECT id FROM employees")
+    allowed_ids = {row[0] for row in cursor.fetchall()}
+
+    imported, errors, batch = 0, [], []
+    try:
+        for line_no, record in read_import_records(stream, fmt):
+            try:
+                batch.append(parse_attendance_record(record, allowed_ids))
+            except ValueError as e:
+                errors.append({'line': line_no, 'error': str(e)})
+                continue
+            if len(batch) >= chunk_size:
+                cursor.executemany(UPSERT_ATTENDANCE_SQL, batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(UPSERT_ATTENDANCE_SQL, batch)
+            imported += len(batch)
+        bump_data_version(cursor, 'attendance')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    elapsed = time.monotonic() - started
+    return {
+        'imported': imported,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(imported / elapsed) if elapsed > 0 else imported
+    }
+
+# ========== ACCOUNT PROVISIONING ==========
+
+class DuplicateEmail(Exception):
+    pass
+
+DEFAULT_EMPLOYEE_PASSWORD = 'password123'
+DEFAULT_HR_PASSWORD = 'hrpassword123'
+
+# Department a self-registered account is placed in
+ROLE_DEFAULT_DEPARTMENTS = {'hr': 'Human Resources', 'employee': 'IT'}
+
+EMPLOYEE_COLUMNS = ('user_id', 'name', 'email', 'phone', 'department_id', 'position', 'salary',
+                    'joining_date', 'emergency_contact', 'address', 'role')
+
+INSERT_USER_SQL = "INSERT INTO users (name, email, password, role) VALUES (%s, %s, %s, %s)"
+INSERT_EMPLOYEE_SQL = f"""
+    INSERT INTO employees ({', '.join(EMPLOYEE_COLUMNS)})
+    VALUES ({', '.join(['%s'] * len(EMPLOYEE_COLUMNS))})
+"""
+
+# Department name -> id, cached because departments are added or renamed rarely
+def get_department_ids():
+    ids = cache.get('departments:ids')
+    if ids is None:
+        cursor = get_db().cursor()
+        cursor.execute("SELECT name, id FROM departments ORDER BY id")
+        ids = {name: dept_id for name, dept_id in cursor.fetchall()}
+        cache.set('departments:ids', ids, app.config['DEPARTMENT_STATS_TTL'])
+    return ids
+
+def invalidate_department_ids():
+    cache.delete('departments:ids')
+
+def default_department_id(role):
+    ids = get_department_ids()
+    return ids.get(ROLE_DEFAULT_DEPARTMENTS.get(role)) or next(iter(ids.values()), None)
+
+# Account fields with the same defaults the employees table would apply; blank values are dropped
+def new_account(name, email, role, **fields):
+    account = {'name': name, 'email': email, 'role': role, 'phone': None, 'department_id': None,
+               'position': 'Staff', 'salary': 0, 'joining_date': date.today(),
+               'emergency_contact': None, 'address': None}
+    account.update({key: value for key, value in fields.items() if value not in (None, '')})
+    return account
+
+def employee_row(user_id, account):
+    return tuple(user_id if column == 'user_id' else account[column] for column in EMPLOYEE_COLUMNS)
+
+# Create the login and the employee record of one account in a single transaction.
+# The unique key on users.email is the duplicate check, so there is no SELECT first;
+# a taken email rolls back and raises DuplicateEmail.
+def provision_account(conn, account, password_hash):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(INSERT_USER_SQL, (account['name'], account['email'], password_hash, account['role']))
+        user_id = cursor.lastrowid
+        cursor.execute(INSERT_EMPLOYEE_SQL, employee_row(user_id, account))
+        bump_data_version(cursor, 'employees')
+        conn.commit()
+    except mysql.connector.IntegrityError as e:
+        conn.rollback()
+        if e.errno == errorcode.ER_DUP_ENTRY:
+            raise DuplicateEmail(account['email'])
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+
+    invalidate_department_headcounts()
+    invalidate_dashboard_stats(account['department_id'])
+    return user_id
+
+def parse_onboarding_record(record, department_ids):
+    if not isinstance(record, dict):
+        raise ValueError("malformed row")
+    name = str(record.get('name') or '').strip()
+    email = str(record.get('email') or '').strip()
+    if not name:
+        raise ValueError("missing name")
+    if '@' not in email:
+        raise ValueError("missing or invalid email")
+    role = str(record.get('role') or 'employee').strip().lower()
+    if role not in ('employee', 'hr'):
+        raise ValueError(f"invalid role '{record.get('role')}'")
+
+    department = str(record.get('department') or '').strip()
+    if department and department not in department_ids:
+        raise ValueError(f"unknown department '{department}'")
+    try:
+        salary = Decimal(str(record.get('salary') or 0).strip())
+    except InvalidOperation:
+        raise ValueError(f"invalid salary '{record.get('salary')}'")
+    joining_date = str(record.get('joining_date') or '').strip()
+    try:
+        joining_date = date.fromisoformat(joining_date) if joining_date else None
+    except ValueError:
+        raise ValueError("invalid joining_date (expected YYYY-MM-DD)")
+
+    return new_account(name, email, role,
+                       phone=str(record.get('phone') or '').strip(),
+                       department_id=department_ids.get(department),
+                       position=str(record.get('position') or '').strip(),
+                       salary=salary,
+                       joining_date=joining_date,
+                       emergency_contact=str(record.get('emergency_contact') or '').strip(),
+                       address=str(record.get('address') or '').strip())
+
+# Onboard employees from a CSV or JSONL stream (name, email, phone, department, position,
+# salary, joining_date, emergency_contact, address, role). Each chunk is one SELECT for
+# emails already registered, one multi-row users INSERT, one SELECT mapping the new user
+# ids back by email and one multi-row employees INSERT. Like the attendance import, the
+# whole file is one transaction: bad rows are reported and skipped, a database error
+# rolls everything back.
+def onboard_employees(conn, stream, fmt, chunk_size=None):
+    chunk_size = chunk_size or app.config['BULK_CHUNK_SIZE']
+    started = time.monotonic()
+    department_ids = get_department_ids()
+    # New accounts get the usual default password, hashed once per role rather than per row
+    password_hashes = {
+        'employee': hash_password(DEFAULT_EMPLOYEE_PASSWORD),
+        'hr': hash_password(DEFAULT_HR_PASSWORD)
+    }
+    cursor = conn.cursor()
+    created, errors, batch, seen, touched_depts = 0, [], [], set(), set()
+
+    def flush(batch):
+        emails = [account['email'] for line_no, account in batch]
+        placeholders = ', '.join(['%s'] * len(emails))
+        cursor.execute(f"SELECT email FROM users WHERE email IN ({placeholders})", emails)
+        taken = {email.lower() for (email,) in cursor.fetchall()}
+        fresh = []
+        for line_no, account in batch:
+            if account['email'].lower() in taken:
+                errors.append({'line': line_no, 'error': f"email {account['email']} already registered"})
+            else:
+                fresh.append(account)
+        if not fresh:
+            return 0
+
+        cursor.executemany(INSERT_USER_SQL, [(a['name'], a['email'], password_hashes[a['role']], a['role']) for a in fresh])
+        placeholders = ', '.join(['%s'] * len(fresh))
+        cursor.execute(f"SELECT email, id FROM users WHERE email IN ({placeholders})", [a['email'] for a in fresh])
+        user_ids = {email.lower(): user_id for email, user_id in cursor.fetchall()}
+        cursor.executemany(INSERT_EMPLOYEE_SQL, [employee_row(user_ids[a['email'].lower()], a) for a in fresh])
+        touched_depts.update(a['department_id'] for a in fresh)
+        return len(fresh)
+
+    try:
+        for line_no, record in read_import_records(stream, fmt):
+            try:
+                account = parse_onboarding_record(record, department_ids)
+            except ValueError as e:
+                errors.append({'line': line_no, 'error': str(e)})
+                continue
+            if account['email'].lower() in seen:
+                errors.append({'line': line_no, 'error': f"duplicate email {account['email']} in file"})
+                continue
+            seen.add(account['email'].lower())
+            batch.append((line_no, account))
+            if len(batch) >= chunk_size:
+                created += flush(batch)
+                batch = []
+        if batch:
+            created += flush(batch)
+        bump_data_version(cursor, 'employees')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    invalidate_department_headcounts()
+    invalidate_dashboard_stats(*touched_depts)
+    elapsed = time.monotonic() - started
+    return {
+        'created': created,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(created / elapsed) if elapsed > 0 else created
+    }
+
+# ========== BULK SALARY CHANGES ==========
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+# Apply {employee_id: new_salary}, touching only rows whose salary actually changes.
+# Each chunk is one SELECT, one CASE-based UPDATE and one multi-row history INSERT.
+# Returns the number of employees whose salary changed; the caller commits.
+def apply_salary_changes(cursor, new_salaries, changed_by, chunk_size=None):
+    chunk_size = chunk_size or app.config['BULK_CHUNK_SIZE']
+    changed = 0
+    # Lock the rows (in id order, so concurrent batches cannot deadlock) until the caller
+    # commits, so a parallel change cannot slip in between reading the old salary and the update
+    for ids in chunked(sorted(new_salaries), chunk_size):
+        placeholders = ', '.join(['%s'] * len(ids))
+        cursor.execute(f"SELECT id, salary FROM employees WHERE id IN ({placeholders}) ORDER BY id FOR UPDATE", ids)
+        changes = [(emp_id, old, new_salaries[emp_id]) for emp_id, old in cursor.fetchall()
+                   if old is None or old != new_salaries[emp_id]]
+        if not changes:
+            continue
+
+        cases = ' '.join(['WHEN %s THEN %s'] * len(changes))
+        params = [value for emp_id, old, new in changes for value in (emp_id, new)]
+        params += [emp_id for emp_id, old, new in changes]
+        cursor.execute(f"""
+            UPDATE employees SET salary = CASE id {cases} END
+            WHERE id IN ({', '.join(['%s'] * len(changes))})
+        """, params)
+        cursor.executemany("""
+            INSERT INTO salary_history (employee_id, old_salary, new_salary, changed_by)
+            VALUES (%s, %s, %s, %s)
+        """, [(emp_id, old, new, changed_by) for emp_id, old, new in changes])
+        changed += len(changes)
+    return changed
+
+# ========== PAYROLL RUN ==========
+
+def working_dates(month_start, month_end):
+    return [month_start + timedelta(days=offset) for offset in range((month_end - month_start).days)
+            if (month_start + timedelta(days=offset)).weekday() < 5]
+
+# Generate the payslips of one month for every salaried employee with a single
+# INSERT ... SELECT, so the whole run is one statement and one transaction.
+# Re-running a month recalculates pending slips and leaves paid ones untouched.
+# The daily rate is salary / Mon-Fri working days, so unpaid leave is counted in the
+# same unit: the working days of the month it covers (overlapping requests count once),
+# and absences on a day already covered by unpaid leave are not deducted again.
+def run_payroll(conn, month_start):
+    month_start, month_end = month_bounds(month_start.strftime('%Y-%m'))
+    dates = working_dates(month_start, month_end)
+    days = len(dates)
+    unpaid_types = [t.strip().lower() for t in app.config['PAYROLL_UNPAID_LEAVE_TYPES']]
+    params = {'month_start': month_start, 'month_end': month_end, 'days': days,
+              'allowance_rate': app.config['PAYROLL_ALLOWANCE_RATE']}
+    params.update((f"type{i}", leave_type) for i, leave_type in enumerate(unpaid_types))
+    params.update((f"day{i}", day) for i, day in enumerate(dates))
+    type_placeholders = ', '.join(f"%(type{i})s" for i in range(len(unpaid_types)))
+    workdays = ' UNION ALL '.join(f"SELECT %(day{i})s AS day" for i in range(days))
+    unpaid_leave = f"""
+        lr.status = 'approved' AND lr.start_date < %(month_end)s AND lr.end_date >= %(month_start)s
+        AND LOWER(lr.leave_type) IN ({type_placeholders})
+    """
+
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        INSERT INTO payroll (employee_id, month_year, basic_salary, allowances, deductions, net_salary, status)
+        SELECT * FROM (
+            SELECT calc.employee_id, %(month_start)s AS month_year, calc.basic_salary, calc.allowances, calc.deductions,
+                   calc.basic_salary + calc.allowances - calc.deductions AS net_salary, 'pending' AS status
+            FROM (
+                SELECT e.id AS employee_id,
+                       e.salary AS basic_salary,
+                       ROUND(e.salary * %(allowance_rate)s, 2) AS allowances,
+                       LEAST(e.salary, ROUND(e.salary / %(days)s * LEAST(%(days)s, COALESCE(att.absent_days, 0) + COALESCE(lv.unpaid_days, 0)), 2)) AS deductions
+                FROM employees e
+                LEFT JOIN (
+                    SELECT a.employee_id,
+                           SUM(CASE a.status WHEN 'absent' THEN 1 WHEN 'half_day' THEN 0.5 ELSE 0 END) AS absent_days
+                    FROM attendance a
+                    WHERE a.date >= %(month_start)s AND a.date < %(month_end)s
+                    AND NOT EXISTS (
+                        SELECT 1 FROM leave_requests lr
+                        WHERE lr.employee_id = a.employee_id AND {unpaid_leave}
+                        AND a.date BETWEEN lr.start_date AND lr.end_date
+                    )
+                    GROUP BY a.employee_id
+                ) att ON att.employee_id = e.id
+                LEFT JOIN (
+                    SELECT lr.employee_id, COUNT(DISTINCT wd.day) AS unpaid_days
+                    FROM leave_requests lr
+                    JOIN ({workdays}) wd ON wd.day BETWEEN lr.start_date AND lr.end_date
+                    WHERE {unpaid_leave}
+                    GROUP BY lr.employee_id
+                ) lv ON lv.employee_id = e.id
+                WHERE e.salary > 0 AND (e.joining_date IS NULL OR e.joining_date < %(month_end)s)
+            ) calc
+        ) run
+        ON DUPLICATE KEY UPDATE
+            basic_salary = IF(payroll.status = 'paid', payroll.basic_salary, run.basic_salary),
+            allowances = IF(payroll.status = 'paid', payroll.allowances, run.allowances),
+            deductions = IF(payroll.status = 'paid', payroll.deductions, run.deductions),
+            net_salary = IF(payroll.status = 'paid', payroll.net_salary, run.net_salary)
+    """, params)
+
+    cursor.execute("""
+        SELECT COUNT(*), COALESCE(SUM(net_salary), 0), COUNT(CASE WHEN status = 'paid' THEN 1 END)
+        FROM payroll WHERE month_year = %s
+    """, (month_start,))
+    payslips, total_net, paid = cursor.fetchone()
+    bump_data_version(cursor, 'payroll')
+    conn.commit()
+    return {'month': month_start.strftime('%Y-%m'), 'payslips': payslips, 'paid': paid,
+            'total_net': total_net, 'working_days': days}
+
+# ========== DOCUMENT STORAGE ==========
+
+# Uploads are stored once per distinct content as UPLOAD_FOLDER/blobs/<aa>/<bb>/<sha256>.
+# document_blobs counts how many documents rows point at each blob; a document delete
+# only drops a reference and gc_blobs() removes blobs nobody references any more.
+
+def blob_relpath(content_hash):
+    return f"blobs/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}"
+
+def blob_path(content_hash):
+    return os.path.join(app.config['UPLOAD_FOLDER'], *blob_relpath(content_hash).split('/'))
+
+# Derived files cached next to a blob (see DOCUMENT PREVIEWS); removed together with it
+BLOB_SIDECARS = ('.txt', '.thumb.jpg')
+
+# Copy an upload into a temp file next to the blobs in fixed-size chunks, hashing as it goes
+def spool_upload(stream):
+    folder = os.path.join(app.config['UPLOAD_FOLDER'], 'blobs', 'tmp')
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.part')
+    digest, size = hashlib.sha256(), 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(app.config['UPLOAD_CHUNK_SIZE'])
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size
+
+# Store an upload as a blob and take a reference on it. The blob row is locked (by the
+# upsert) before the file is moved into place, so a concurrent GC pass cannot delete it
+# in between. Returns (content_hash, size); the caller inserts the document and commits.
+def store_blob(cursor, stream):
+    tmp_path, content_hash, size = spool_upload(stream)
+    try:
+        cursor.execute("""
+            INSERT INTO document_blobs (hash, size_bytes, ref_count) VALUES (%s, %s, 1)
+            ON DUPLICATE KEY UPDATE ref_count = ref_count + 1
+        """, (content_hash, size))
+        path = blob_path(content_hash)
+        if os.path.exists(path):
+            # Same content is already stored
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return content_hash, size
+
+def release_blob(cursor, content_hash):
+    cursor.execute("UPDATE document_blobs SET ref_count = ref_count - 1 WHERE hash = %s AND ref_count > 0",
+                   (content_hash,))
+
+# Documents of a user are removed by ON DELETE CASCADE, so release their blobs first and
+# drop their cached download metadata. Returns the document ids so the caller can drop
+# the cache again after committing, in case a download re-cached one in between.
+def release_user_documents(cursor, user_id):
+    cursor.execute("SELECT id FROM documents WHERE user_id = %s FOR UPDATE", (user_id,))
+    doc_ids = [row[0] for row in cursor.fetchall()]
+    invalidate_document_meta(*doc_ids)
+    cursor.execute("""
+        UPDATE document_blobs b
+        JOIN (
+            SELECT content_hash, COUNT(*) AS refs FROM documents
+            WHERE user_id = %s AND content_hash IS NOT NULL
+            GROUP BY content_hash
+        ) d ON d.content_hash = b.hash
+        SET b.ref_count = GREATEST(b.ref_count - d.refs, 0)
+    """, (user_id,))
+    return doc_ids
+
+# Delete unreferenced blobs, then sweep files that have no blob row at all (left behind
+# by an upload that failed before committing). Files younger than `grace` seconds are
+# skipped so uploads still in flight are never touched.
+def gc_blobs(conn, grace=None):
+    grace = app.config['BLOB_GC_GRACE'] if grace is None else grace
+    cursor = conn.cursor()
+    cursor.execute("SELECT hash FROM document_blobs WHERE ref_count = 0 FOR UPDATE")
+    unreferenced = [row[0] for row in cursor.fetchall()]
+    freed = 0
+    for content_hash in unreferenced:
+        for path in [blob_path(content_hash)] + [blob_path(content_hash) + suffix for suffix in BLOB_SIDECARS]:
+            try:
+                freed += os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    for hashes in chunked(unreferenced, app.config['BULK_CHUNK_SIZE']):
+        cursor.execute(f"DELETE FROM document_blobs WHERE hash IN ({', '.join(['%s'] * len(hashes))}) AND ref_count = 0",
+                       hashes)
+    conn.commit()
+
+    cutoff = time.time() - grace
+    candidates = {}
+    for dirpath, dirnames, filenames in os.walk(os.path.join(app.config['UPLOAD_FOLDER'], 'blobs')):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.getmtime(path) < cutoff:
+                candidates[name] = path
+    orphans = [name for name in candidates if name.endswith('.part')]
+    blob_names = [name for name in candidates if not name.endswith('.part')]
+    for names in chunked(blob_names, app.config['BULK_CHUNK_SIZE']):
+        # Sidecars are named <hash><suffix> and belong to the blob <hash>
+        hashes = list({name.split('.')[0] for name in names})
+        cursor.execute(f"SELECT hash FROM document_blobs WHERE hash IN ({', '.join(['%s'] * len(hashes))})", hashes)
+        known = {row[0] for row in cursor.fetchall()}
+        orphans += [name for name in names if name.split('.')[0] not in known]
+    conn.rollback()
+    for name in orphans:
+        try:
+            freed += os.path.getsize(candidates[name])
+            os.remove(candidates[name])
+        except FileNotFoundError:
+            pass
+
+    return {'blobs_removed': len(unreferenced), 'orphans_removed': len(orphans), 'bytes_freed': freed}
+
+# Owner, path and content metadata of a document, cached per document for the download route
+def get_document_meta(doc_id):
+    key = f"documents:meta:{doc_id}"
+    meta = cache.get(key)
+    if meta is None:
+        cursor = get_db().cursor(dictionary=True)
+        cursor.execute("""
+            SELECT id, user_id, file_path, content_hash, original_name, content_type
+            FROM documents WHERE id = %s
+        """, (doc_id,))
+        meta = cursor.fetchone() or {}
+        cache.set(key, meta, app.config['DOCUMENT_META_TTL'])
+    return meta or None
+
+def invalidate_document_meta(*doc_ids):
+    for doc_id in doc_ids:
+        cache.delete(f"documents:meta:{doc_id}")
+
+# Admins see every document, HR the documents of their department, everyone else their own
+def can_view_document(meta):
+    if session['role'] == 'admin' or meta['user_id'] == session['user_id']:
+        return True
+    if session['role'] == 'hr' and session.get('dept_id'):
+        owner = get_identity(meta['user_id'])
+        return bool(owner) and owner['department_id'] == session['dept_id']
+    return False
+
+# ========== DOCUMENT PREVIEWS ==========
+
+# After an upload commits, a process pool builds the derivatives of a new blob: a JPEG
+# thumbnail for images (needs Pillow) and the text of PDFs (needs pypdf) and text files.
+# Both are cached next to the blob, so listing documents never opens the originals, and
+# the text is copied into document_texts for the admin content search. Identical uploads
+# share a blob and are only processed once. A blob whose extractor is not installed
+# stays pending, so `flask build-previews` processes it once the package is added.
+
+class PreviewUnavailable(Exception):
+    pass
+
+_preview_executor = None
+_preview_executor_pid = None
+
+def get_preview_executor():
+    global _preview_executor, _preview_executor_pid
+    if _preview_executor is None or _preview_executor_pid != os.getpid():
+        _preview_executor = ProcessPoolExecutor(max_workers=app.config['DOCUMENT_PREVIEW_WORKERS'],
+                                                mp_context=multiprocessing.get_context('spawn'))
+        _preview_executor_pid = os.getpid()
+    return _preview_executor
+
+def extract_document_text(path, head, content_type, max_chars):
+    if head.startswith(b'%PDF'):
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            raise PreviewUnavailable("pypdf is not installed")
+        parts, length = [], 0
+        for pdf_page in PdfReader(path).pages:
+            text = pdf_page.extract_text() or ''
+            parts.append(text)
+            length += len(text)
+            if length >= max_chars:
+                break
+        return '\n'.join(parts)[:max_chars]
+    if (content_type or '').startswith('text/') or content_type in ('application/json', 'application/csv'):
+        with open(path, 'rb') as f:
+            return f.read(max_chars * 4).decode('utf-8', errors='replace')[:max_chars]
+    return None
+
+def build_thumbnail(path, thumb_path, size):
+    try:
+        from PIL import Image
+    except ImportError:
+        raise PreviewUnavailable("Pillow is not installed")
+    try:
+        with Image.open(path) as image:
+            image.thumbnail((size, size))
+            image.convert('RGB').save(thumb_path + '.tmp', 'JPEG', quality=80)
+    except (OSError, ValueError):
+        # Not an image Pillow can read
+        return False
+    os.replace(thumb_path + '.tmp', thumb_path)
+    return True
+
+# Runs in a worker process: writes the sidecar files and records the result
+def build_document_preview(path, content_hash, content_type, connect_args, max_chars, thumb_size):
+    state, has_thumbnail, text = 'done', False, None
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(8)
+        text = extract_document_text(path, head, content_type, max_chars)
+        if text is not None:
+            text = text.replace('\x00', '').strip()
+            with open(path + '.txt.tmp', 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(path + '.txt.tmp', path + '.txt')
+        if (content_type or '').startswith('image/'):
+            has_thumbnail = build_thumbnail(path, path + '.thumb.jpg', thumb_size)
+    except PreviewUnavailable as e:
+        print(f"Document preview skipped for {content_hash}: {e}")
+        state = 'pending'
+    except Exception as e:
+        print(f"Document preview error for {content_hash}: {e}")
+        state = 'failed'
+
+    conn = mysql.connector.connect(**connect_args)
+    try:
+        cursor = conn.cursor()
+        if text:
+            cursor.execute("""
+                INSERT INTO document_texts (hash, content) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE content = VALUES(content)
+            """, (content_hash, text))
+        cursor.execute("UPDATE document_blobs SET preview_state = %s, has_thumbnail = %s WHERE hash = %s",
+                       (state, has_thumbnail, content_hash))
+        conn.commit()
+    finally:
+        conn.close()
+    return state
+
+# Queue the derivatives of a blob unless an earlier upload of the same content built them
+def queue_document_preview(cursor, content_hash, content_type):
+    cursor.execute("SELECT preview_state FROM document_blobs WHERE hash = %s", (content_hash,))
+    row = cursor.fetchone()
+    if row is None or row[0] != 'pending':
+        return False
+    try:
+        get_preview_executor().submit(build_document_preview, os.path.abspath(blob_path(content_hash)), content_hash,
+                                      content_type, db_pool.connect_args, app.config['DOCUMENT_TEXT_MAX_CHARS'],
+                                      app.config['DOCUMENT_THUMBNAIL_SIZE'])
+    except RuntimeError as e:
+        # Pool shut down (interpreter exiting); `flask build-previews` picks the blob up later
+        print(f"Document preview queue error: {e}")
+        return False
+    return True
+
+def thumbnail_path(content_hash):
+    return blob_path(content_hash) + '.thumb.jpg'
+
+# ========== LEAVE LEDGER ==========
+
+# leave_balances holds entitled / used / pending days per employee, leave type and year,
+# so balance checks are a primary-key lookup instead of a sum over leave history.
+# Requests are charged to the year they start in and count calendar days, weekends
+# included, the same total_days the leave pages show. This differs from payroll, which
+# only deducts the working (Mon-Fri) days of unpaid leave. Types without annual_days
+# (unpaid leave) are not tracked.
+
+# Seed or refresh a year's balances: annual entitlement plus carry-forward from the
+# previous year. New rows take used/pending from that year's existing requests; rows
+# that already exist only get their entitlement recalculated, so re-running is safe.
+ACCRUE_LEAVE_SQL = """
+    INSERT INTO leave_balances (employee_id, leave_type, year, entitled, used, pending)
+    SELECT e.id, lt.code, %(year)s,
+           lt.annual_days + LEAST(lt.carry_forward_max, GREATEST(COALESCE(prev.entitled - prev.used, 0), 0)),
+           COALESCE(hist.used, 0), COALESCE(hist.pending, 0)
+    FROM employees e
+    CROSS JOIN leave_types lt
+    LEFT JOIN leave_balances prev
+        ON prev.employee_id = e.id AND prev.leave_type = lt.code AND prev.year = %(year)s - 1
+    LEFT JOIN (
+        SELECT employee_id, leave_type,
+               SUM(CASE WHEN status = 'approved' THEN DATEDIFF(end_date, start_date) + 1 ELSE 0 END) AS used,
+               SUM(CASE WHEN status = 'pending' THEN DATEDIFF(end_date, start_date) + 1 ELSE 0 END) AS pending
+        FROM leave_requests
+        WHERE start_date >= %(year_start)s AND start_date < %(next_year_start)s {request_filter}
+        GROUP BY employee_id, leave_type
+    ) hist ON hist.employee_id = e.id AND hist.leave_type = lt.code
+    WHERE lt.annual_days IS NOT NULL {employee_filter}
+    ON DUPLICATE KEY UPDATE entitled = VALUES(entitled)
+"""
+
+def accrue_leave_sql(year, employee_id=None):
+    params = {'year': year, 'year_start': date(year, 1, 1), 'next_year_start': date(year + 1, 1, 1)}
+    if employee_id is None:
+        return ACCRUE_LEAVE_SQL.format(request_filter='', employee_filter=''), params
+    params['employee_id'] = employee_id
+    return ACCRUE_LEAVE_SQL.format(request_filter='AND employee_id = %(employee_id)s',
+                                   employee_filter='AND e.id = %(employee_id)s'), params
+
+# Yearly accrual for every employee; the caller's connection is committed
+def accrue_leave(conn, year):
+    cursor = conn.cursor()
+    sql, params = accrue_leave_sql(year)
+    cursor.execute(sql, params)
+    cursor.execute("SELECT COUNT(*) FROM leave_balances WHERE year = %s", (year,))
+    balances = cursor.fetchone()[0]
+    conn.commit()
+    return balances
+
+# code -> {'code', 'name', 'annual_days', 'carry_forward_max'}, in display order
+def get_leave_types():
+    types = cache.get('leave:types')
+    if types is None:
+        cursor = get_db().cursor(dictionary=True)
+        cursor.execute("SELECT code, name, annual_days, carry_forward_max FROM leave_types ORDER BY id")
+        types = {row['code']: row for row in cursor.fetchall()}
+        cache.set('leave:types', types, app.config['DEPARTMENT_STATS_TTL'])
+    return types
+
+# Calendar days of a request, matching DATEDIFF(end_date, start_date) + 1 in the SQL
+def leave_days(start_date, end_date):
+    return (end_date - start_date).days + 1
+
+# Balances of one employee for one year, creating them on first use (e.g. someone who
+# joined after the yearly accrual ran)
+def get_leave_balances(cursor, employee_id, year):
+    query = """
+        SELECT b.leave_type, lt.name, b.entitled, b.used, b.pending,
+               b.entitled - b.used - b.pending AS available
+        FROM leave_balances b
+        JOIN leave_types lt ON lt.code = b.leave_type
+        WHERE b.employee_id = %s AND b.year = %s
+        ORDER BY lt.id
+    """
+    cursor.execute(query, (employee_id, year))
+    balances = cursor.fetchall()
+    if not balances and employee_id:
+        sql, params = accrue_leave_sql(year, employee_id)
+        cursor.execute(sql, params)
+        cursor.execute(query, (employee_id, year))
+        balances = cursor.fetchall()
+    return balances
+
+RESERVE_LEAVE_SQL = """
+    UPDATE leave_balances SET pending = pending + %s
+    WHERE employee_id = %s AND leave_type = %s AND year = %s AND entitled - used - pending >= %s
+"""
+
+# Hold the requested days as pending. The balance check and the reservation are one
+# conditional UPDATE, so two concurrent applications cannot both spend the last days.
+# Returns False when the balance is insufficient.
+def reserve_leave(cursor, employee_id, leave_type, start_date, end_date):
+    if get_leave_types()[leave_type]['annual_days'] is None:
+        return True
+    days, year = leave_days(start_date, end_date), start_date.year
+    reserve_params = (days, employee_id, leave_type, year, days)
+    cursor.execute(RESERVE_LEAVE_SQL, reserve_params)
+    if cursor.rowcount:
+        return True
+    # No balance row yet: create the year's balances and try once more
+    cursor.execute("SELECT 1 FROM leave_balances WHERE employee_id = %s AND leave_type = %s AND year = %s",
+                   (employee_id, leave_type, year))
+    if cursor.fetchone():
+        return False
+    sql, params = accrue_leave_sql(year, employee_id)
+    cursor.execute(sql, params)
+    cursor.execute(RESERVE_LEAVE_SQL, reserve_params)
+    return cursor.rowcount > 0
+
+# Move decided requests' days out of pending (into used when approved) with one UPDATE.
+# Untracked leave types have no balance rows and are left alone by the join.
+def settle_leaves(cursor, leave_ids, approved):
+    placeholders = ', '.join(['%s'] * len(leave_ids))
+    cursor.execute(f"""
+        UPDATE leave_balances b
+        JOIN (
+            SELECT employee_id, leave_type, YEAR(start_date) AS year,
+                   SUM(DATEDIFF(end_date, start_date) + 1) AS days
+            FROM leave_requests
+            WHERE id IN ({placeholders})
+            GROUP BY employee_id, leave_type, YEAR(start_date)
+        ) d ON b.employee_id = d.employee_id AND b.leave_type = d.leave_type AND b.year = d.year
+        SET b.pending = GREATEST(b.pending - d.days, 0), b.used = b.used + IF(%s, d.days, 0)
+    """, list(leave_ids) + [approved])
+
+# Approve or reject pending requests as a set: lock the ones in scope, flip their status
+# with one UPDATE, settle their balances with one UPDATE and notify the employees with
+# one multi-row INSERT. scoped confines the decision to dept_id (HR), and a NULL dept_id
+# then matches nothing; ids that are out of scope or no longer pending are skipped. Returns (leave_id, department_id,
+# user_id) of the decided requests; the caller commits and then invalidates the
+# employees' notification counts.
+def decide_leave_requests(cursor, leave_ids, approve, decided_by, scoped=False, dept_id=None):
+    if not leave_ids:
+        return []
+    placeholders = ', '.join(['%s'] * len(leave_ids))
+    params = list(leave_ids)
+    scope = ''
+    if scoped:
+        scope = ' AND e.department_id = %s'
+        params.append(dept_id)
+    cursor.execute(f"""
+        SELECT lr.id, e.user_id, e.department_id
+        FROM leave_requests lr
+        JOIN employees e ON lr.employee_id = e.id
+        WHERE lr.id IN ({placeholders}) AND lr.status = 'pending'{scope}
+        FOR UPDATE
+    """, params)
+    rows = cursor.fetchall()
+    if not rows:
+        return []
+
+    ids = [leave_id for leave_id, user_id, department_id in rows]
+    outcome = 'approved' if approve else 'rejected'
+    cursor.execute(f"""
+        UPDATE leave_requests
+        SET status = %s, approved_by = %s, approved_date = NOW()
+        WHERE id IN ({', '.join(['%s'] * len(ids))})
+    """, [outcome, decided_by] + ids)
+    settle_leaves(cursor, ids, approve)
+    notify_many(cursor, [(user_id, f"Your leave request #{leave_id} has been {outcome}.")
+                         for leave_id, user_id, department_id in rows])
+    return [(leave_id, department_id, user_id) for leave_id, user_id, department_id in rows]
 
 # Inject 'now' and 'notification_count' into all templates
 @app.context_processor
 def inject_globals():
     context = {'now': datetime.now()}
     if 'user_id' in session:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT COUNT(*) as count FROM notifications WHERE user_id = %s AND is_read = 0", (session['user_id'],))
-        result = cursor.fetchone()
-        context['notification_count'] = result['count'] if result else 0
-        conn.close()
+        context['notification_count'] = get_notification_count(session['user_id'])
     return context
 
-def log_audit(action, details=None):
-    if 'user_id' in session:
+# ========== AUDIT LOG WRITER ==========
+
+# Background writer for audit_logs. Requests only enqueue a tuple; a daemon thread
+# drains the queue and inserts rows in batches of up to AUDIT_BATCH_SIZE, at least
+# every AUDIT_FLUSH_INTERVAL seconds. The thread is started lazily so that each
+# gunicorn worker gets its own after forking.
+class AuditWriter:
+    INSERT_SQL = """
+        INSERT INTO audit_logs (user_id, action, details, ip_address, timestamp)
+        VALUES (%s, %s, %s, %s, %s)
+    """
+
+    def __init__(self, pool, batch_size, flush_interval, max_queue, overflow, block_timeout):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.stats = {'queued': 0, 'written': 0, 'dropped': 0, 'failed': 0}
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, user_id, action, details, ip_address):
+        self._ensure_started()
+        event = (user_id, action, details, ip_address, datetime.now())
+        try:
+            if self.overflow == 'block':
+                self._queue.put(event, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(event)
+            self.stats['queued'] += 1
+        except queue.Full:
+            self.stats['dropped'] += 1
+            print(f"Audit log queue full, dropped event: {action}")
+
+    def _drain(self, first=None):
+        batch = [first] if first is not None else []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            # Give a burst a moment to accumulate into one statement
+            if self._queue.qsize() < self.batch_size:
+                self._stop.wait(min(0.05, self.flush_interval))
+            self._write(self._drain(first))
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            conn = self.pool.acquire()
+        except Exception as e:
+            self.stats['failed'] += len(batch)
+            print(f"Audit log error: {e}")
+            return
         try:
-            conn = get_db_connection()
             cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO audit_logs (user_id, action, details, ip_address)
-                VALUES (%s, %s, %s, %s)
-            """, (session['user_id'], action, details, request.remote_addr))
+            cursor.executemany(self.INSERT_SQL, batch)
             conn.commit()
-            conn.close()
+            self.stats['written'] += len(batch)
         except Exception as e:
+            self.stats['failed'] += len(batch)
             print(f"Audit log error: {e}")
+        finally:
+            self.pool.release(conn)
+
+    # Write everything still queued; called on interpreter shutdown
+    def flush(self):
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=self.flush_interval + 1)
+        while True:
+            batch = self._drain()
+            if not batch:
+                break
+            self._write(batch)
+
+audit_writer = AuditWriter(
+    db_pool,
+    batch_size=app.config['AUDIT_BATCH_SIZE'],
+    flush_interval=app.config['AUDIT_FLUSH_INTERVAL'],
+    max_queue=app.config['AUDIT_QUEUE_SIZE'],
+    overflow=app.config['AUDIT_OVERFLOW'],
+    block_timeout=app.config['AUDIT_BLOCK_TIMEOUT']
+)
+atexit.register(audit_writer.flush)
+
+def log_audit(action, details=None):
+    if 'user_id' in session:
+        audit_writer.submit(session['user_id'], action, details, request.remote_addr)
+
+# Turn a 'YYYY-MM' month (defaults to the current one) into half-open [first_day, next_month)
+# bounds. Filtering the raw date column with these keeps the query sargable.
+def month_bounds(month=None):
+    try:
+        first_day = datetime.strptime(month, '%Y-%m').date()
+    except (TypeError, ValueError):
+        first_day = date.today().replace(day=1)
+    next_month = (first_day.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return first_day, next_month
+
+
+# ========== AUDIT RETENTION ==========
+
+# audit_logs only holds the last AUDIT_RETENTION_MONTHS months. archive_audit_logs()
+# moves each older month into AUDIT_ARCHIVE_FOLDER/audit-YYYY-MM-<n>.jsonl.gz and records
+# the file in audit_archives; query_audit_logs() reads the hot table and the archive
+# files whose time range matches, so callers see one log. Archive files are written
+# newest first, in (timestamp, id) order, so a page can stop reading a file early.
+
+AUDIT_FIELDS = ('id', 'user_id', 'action', 'details', 'ip_address', 'timestamp')
+
+def audit_cutoff(retention_months=None):
+    retention_months = app.config['AUDIT_RETENTION_MONTHS'] if retention_months is None else retention_months
+    cutoff = date.today().replace(day=1)
+    for _ in range(max(retention_months - 1, 0)):
+        cutoff = (cutoff - timedelta(days=1)).replace(day=1)
+    return cutoff
+
+def write_audit_archive(conn, month, start, end, fetch_size):
+    folder = app.config['AUDIT_ARCHIVE_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute("SELECT COUNT(*) AS parts FROM audit_archives WHERE month = %s", (month,))
+    file_name = f"audit-{month}-{cursor.fetchone()['parts'] + 1}.jsonl.gz"
+    path = os.path.join(folder, file_name)
+
+    summary = {'row_count': 0, 'first_id': None, 'last_id': None, 'min_timestamp': None, 'max_timestamp': None}
+    seek, seek_params = '', ()
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        while True:
+            cursor.execute(f"""
+                SELECT id, user_id, action, details, ip_address, timestamp FROM audit_logs
+                WHERE timestamp >= %s AND timestamp < %s {seek}
+                ORDER BY timestamp DESC, id DESC LIMIT %s
+            """, (start, end) + seek_params + (fetch_size,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                f.write(json.dumps(row, default=str) + '\n')
+            summary['row_count'] += len(rows)
+            summary['max_timestamp'] = summary['max_timestamp'] or rows[0]['timestamp']
+            summary['min_timestamp'] = rows[-1]['timestamp']
+            summary['first_id'] = min(summary['first_id'] or rows[0]['id'], *(row['id'] for row in rows))
+            summary['last_id'] = max(summary['last_id'] or 0, *(row['id'] for row in rows))
+            seek = "AND (timestamp < %s OR (timestamp = %s AND id < %s))"
+            seek_params = (rows[-1]['timestamp'], rows[-1]['timestamp'], rows[-1]['id'])
+    if not summary['row_count']:
+        os.remove(path + '.tmp')
+        return None
+    os.replace(path + '.tmp', path)
+
+    cursor.execute("""
+        INSERT INTO audit_archives (month, file_name, row_count, first_id, last_id, min_timestamp, max_timestamp)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """, (month, file_name, summary['row_count'], summary['first_id'], summary['last_id'],
+          summary['min_timestamp'], summary['max_timestamp']))
+    conn.commit()
+    return summary
+
+# Delete the rows of [start, end) that an archive file already holds, a chunk at a time
+def purge_archived_audit_logs(conn, start, end, last_id, chunk_size):
+    cursor = conn.cursor()
+    deleted = 0
+    while True:
+        cursor.execute("""
+            DELETE FROM audit_logs WHERE timestamp >= %s AND timestamp < %s AND id <= %s
+            ORDER BY id LIMIT %s
+        """, (start, end, last_id, chunk_size))
+        conn.commit()
+        deleted += cursor.rowcount
+        if cursor.rowcount < chunk_size:
+            return deleted
+
+# Move every month before the retention cutoff out of audit_logs. A run that stopped
+# half way is safe to repeat: rows already written to a file are purged first, using the
+# last id recorded for that month, and only the remainder is written to a new file.
+def archive_audit_logs(conn, retention_months=None):
+    cutoff = audit_cutoff(retention_months)
+    chunk_size = app.config['BULK_CHUNK_SIZE']
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute("SELECT MIN(timestamp) AS oldest FROM audit_logs WHERE timestamp < %s", (cutoff,))
+    oldest = cursor.fetchone()['oldest']
+    conn.rollback()
+
+    archived = []
+    month_start = oldest.date().replace(day=1) if oldest else cutoff
+    while month_start < cutoff:
+        month = month_start.strftime('%Y-%m')
+        start, end = month_bounds(month)
+        cursor.execute("SELECT MAX(last_id) AS last_id FROM audit_archives WHERE month = %s", (month,))
+        done_up_to = cursor.fetchone()['last_id']
+        conn.rollback()
+        purged = purge_archived_audit_logs(conn, start, end, done_up_to, chunk_size) if done_up_to else 0
+
+        summary = write_audit_archive(conn, month, start, end, app.config['EXPORT_FETCH_SIZE'])
+        if summary:
+            purged += purge_archived_audit_logs(conn, start, end, summary['last_id'], chunk_size)
+        if summary or purged:
+            archived.append({'month': month, 'rows': summary['row_count'] if summary else 0, 'purged': purged})
+        month_start = end
+    return archived
+
+def read_audit_archive(file_name):
+    try:
+        with gzip.open(os.path.join(app.config['AUDIT_ARCHIVE_FOLDER'], file_name), 'rt', encoding='utf-8') as f:
+            for line in f:
+                row = json.loads(line)
+                row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+                yield row
+    except FileNotFoundError:
+        print(f"Audit archive missing: {file_name}")
+
+def audit_sort_key(row):
+    return (row['timestamp'], row['id'])
+
+# Matching rows of one archive file for a page, reading the file (newest first) no further
+# than needed. Newest-first pages stop below `bound`, the oldest row that can still make
+# the page; pages walking back towards newer rows (`after`) stop at the seek row and keep
+# the limit + 1 rows just above it.
+def scan_audit_archive(file_name, matches, limit, before=None, after=None, bound=None):
+    found = deque(maxlen=limit + 1) if after else []
+    rows = read_audit_archive(file_name)
+    try:
+        for row in rows:
+            key = audit_sort_key(row)
+            if after:
+                if key <= after:
+                    break
+            elif bound and key < bound:
+                break
+            elif before and key >= before:
+                continue
+            if matches(row):
+                found.append(row)
+                if not after and len(found) > limit:
+                    break
+    finally:
+        rows.close()
+    return list(found)
+
+# Newest-first audit entries matching the filters, from audit_logs and the archives.
+# `before` is the (timestamp, id) of the last row of the previous page; `after` that of
+# the first row of the next page, for walking back. Archive files are only opened when
+# their time range can still contribute to this page.
+def query_audit_logs(cursor, user_id=None, action=None, start=None, end=None, before=None, after=None, limit=None):
+    limit = limit or app.config['PAGE_SIZE']
+    newest_first = after is None
+    clauses, params = [], []
+    if user_id:
+        clauses.append("a.user_id = %s")
+        params.append(user_id)
+    if action:
+        clauses.append("a.action = %s")
+        params.append(action)
+    if start:
+        clauses.append("a.timestamp >= %s")
+        params.append(start)
+    if end:
+        clauses.append("a.timestamp < %s")
+        params.append(end)
+    if before:
+        clauses.append("(a.timestamp < %s OR (a.timestamp = %s AND a.id < %s))")
+        params += [before[0], before[0], before[1]]
+    if after:
+        clauses.append("(a.timestamp > %s OR (a.timestamp = %s AND a.id > %s))")
+        params += [after[0], after[0], after[1]]
+    order = 'DESC' if newest_first else 'ASC'
+    cursor.execute(f"""
+        SELECT a.id, a.user_id, a.action, a.details, a.ip_address, a.timestamp
+        FROM audit_logs a
+        {'WHERE ' + ' AND '.join(clauses) if clauses else ''}
+        ORDER BY a.timestamp {order}, a.id {order} LIMIT %s
+    """, params + [limit + 1])
+    rows = cursor.fetchall()
+
+    # Only archives overlapping the requested range, and on the near side of the seek row
+    archive_clauses, archive_params = [], []
+    for column, op, value in (('max_timestamp', '>=', start), ('min_timestamp', '<', end),
+                              ('min_timestamp', '<=', before[0] if before else None),
+                              ('max_timestamp', '>=', after[0] if after else None)):
+        if value:
+            archive_clauses.append(f"{column} {op} %s")
+            archive_params.append(value)
+    cursor.execute(f"""
+        SELECT file_name, min_timestamp, max_timestamp FROM audit_archives
+        {'WHERE ' + ' AND '.join(archive_clauses) if archive_clauses else ''}
+        ORDER BY {'max_timestamp DESC' if newest_first else 'min_timestamp ASC'}
+    """, archive_params)
+    archives = cursor.fetchall()
+
+    def matches(row):
+        return ((not user_id or row['user_id'] == int(user_id)) and (not action or row['action'] == action)
+                and (not start or row['timestamp'] >= start) and (not end or row['timestamp'] < end))
+
+    for archive in archives:
+        # Once the page is full, files entirely past its last row cannot change it
+        bound = audit_sort_key(rows[limit]) if len(rows) > limit else None
+        if bound and newest_first and archive['max_timestamp'] < bound[0]:
+            break
+        if bound and not newest_first and archive['min_timestamp'] > bound[0]:
+            break
+        found = scan_audit_archive(archive['file_name'], matches, limit, before, after, bound if newest_first else None)
+        if newest_first:
+            rows = heapq.nlargest(limit + 1, rows + found, key=audit_sort_key)
+        else:
+            rows = heapq.nsmallest(limit + 1, rows + found, key=audit_sort_key)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not newest_first:
+        rows.reverse()
+
+    # Names are looked up once per page; archived entries may outlive their user
+    user_ids = list({row['user_id'] for row in rows if row['user_id']})
+    users = {}
+    if user_ids:
+        cursor.execute(f"SELECT id, name, role FROM users WHERE id IN ({', '.join(['%s'] * len(user_ids))})", user_ids)
+        users = {user['id']: user for user in cursor.fetchall()}
+    for row in rows:
+        user = users.get(row['user_id'])
+        row['user_name'] = user['name'] if user else None
+        row['user_role'] = user['role'] if user else None
+    return rows, has_more
+
+# Audit pages seek on (timestamp, id); any token that does not decode to that is rejected
+def decode_audit_cursor(token):
+    seek = decode_page_cursor(token)
+    if seek is None:
+        raise ValueError('Invalid page cursor')
+    direction, timestamp, row_id = seek
+    try:
+        timestamp = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid page cursor')
+    if type(row_id) is not int:
+        raise ValueError('Invalid page cursor')
+    return direction, (timestamp, row_id)
+
+# Parse the audit filters of a request; raises ValueError on malformed input
+def audit_log_filters(args):
+    filters = {}
+    if args.get('user_id'):
+        filters['user_id'] = int(args['user_id'])
+    if args.get('action'):
+        filters['action'] = args['action'].strip()
+    if args.get('from'):
+        filters['start'] = datetime.strptime(args['from'], '%Y-%m-%d')
+    if args.get('to'):
+        # Inclusive end date
+        filters['end'] = datetime.strptime(args['to'], '%Y-%m-%d') + timedelta(days=1)
+    if args.get('cursor'):
+        direction, seek = decode_audit_cursor(args['cursor'])
+        filters['before' if direction == 'next' else 'after'] = seek
+    return filters
+
+# Next/previous/first links of an audit page, in the same shape keyset_page() returns
+def audit_page_links(endpoint, rows, has_more, filters):
+    args = request.args.to_dict()
+    args.pop('cursor', None)
+    going_back = 'after' in filters
+    has_next = bool(rows) and (has_more if not going_back else True)
+    has_prev = bool(rows) and (has_more if going_back else 'before' in filters)
+    return {
+        'rows': rows,
+        'next_url': url_for(endpoint, cursor=encode_page_cursor('next', rows[-1], 'timestamp'), **args) if has_next else None,
+        'prev_url': url_for(endpoint, cursor=encode_page_cursor('prev', rows[0], 'timestamp'), **args) if has_prev else None,
+        'first_url': url_for(endpoint, **args) if 'before' in filters or 'after' in filters else None
+    }
+
+
+# ========== KEYSET PAGINATION ==========
+
+# Cursor tokens carry the direction and the (sort value, id) of the row to seek from
+def encode_page_cursor(direction, row, sort_key):
+    payload = json.dumps([direction, row[sort_key], row['id']], default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_page_cursor(token):
+    try:
+        direction, sort_value, row_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        return None
+    # Anything but a scalar sort value and an integer id did not come from encode_page_cursor
+    if direction not in ('next', 'prev') or isinstance(sort_value, bool) or isinstance(row_id, bool):
+        return None
+    if not isinstance(sort_value, (str, int, float)) or not isinstance(row_id, int):
+        return None
+    return (direction, sort_value, row_id)
+
+# Fetch one page of `sql` ordered by (sort_column, id_column) using a seek condition
+# instead of OFFSET, so every page costs the same however deep it is. `sql` must end
+# with its WHERE clause (use WHERE 1 = 1 if there is no filter). Page size and cursor
+# come from the ?per_page= and ?cursor= query args.
+def keyset_page(cursor, sql, params, sort_column, id_column, descending=True):
+    sort_key = sort_column.split('.')[-1]
+    try:
+        page_size = min(max(int(request.args.get('per_page', app.config['PAGE_SIZE'])), 1), app.config['MAX_PAGE_SIZE'])
+    except ValueError:
+        page_size = app.config['PAGE_SIZE']
+    seek = decode_page_cursor(request.args.get('cursor', ''))
+    going_back = seek is not None and seek[0] == 'prev'
+
+    # Previous pages walk the index the other way round and flip the rows afterwards
+    desc = descending != going_back
+    params = list(params)
+    if seek:
+        op = '<' if desc else '>'
+        sql += f" AND ({sort_column} {op} %s OR ({sort_column} = %s AND {id_column} {op} %s))"
+        params += [seek[1], seek[1], seek[2]]
+    order = 'DESC' if desc else 'ASC'
+    sql += f" ORDER BY {sort_column} {order}, {id_column} {order} LIMIT %s"
+    params.append(page_size + 1)
+
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if going_back:
+        rows.reverse()
+
+    has_next = has_more if not going_back else True
+    has_prev = seek is not None and (has_more if going_back else True)
+
+    def page_url(token):
+        args = dict(request.view_args or {}, **request.args.to_dict())
+        args['cursor'] = token
+        return url_for(request.endpoint, **args)
+
+    return {
+        'rows': rows,
+        'page_size': page_size,
+        'next_url': page_url(encode_page_cursor('next', rows[-1], sort_key)) if rows and has_next else None,
+        'prev_url': page_url(encode_page_cursor('prev', rows[0], sort_key)) if rows and has_prev else None,
+        'first_url': page_url(None) if seek else None
+    }
+
+# ========== EMPLOYEE SEARCH ==========
+
+EMPLOYEE_SEARCH_SQL = """
+    SELECT e.*, d.name as department_name, u.email as user_email
+    FROM employees e
+    LEFT JOIN departments d ON e.department_id = d.id
+    LEFT JOIN users u ON e.user_id = u.id
+    WHERE 1 = 1
+"""
+
+EMPLOYEE_SEARCH_FIELDS = ('id', 'name', 'email', 'phone', 'department_id', 'department_name', 'position', 'role', 'joining_date')
+
+# Build the WHERE conditions for an employee search from query args. Text search is a
+# prefix match on name or email so both can be range-scanned on their indexes; a
+# leading-wildcard LIKE would scan every row. scoped pins the search to dept_id (HR)
+# whatever the query says, and a NULL dept_id then matches nothing. Raises ValueError
+# on a malformed date.
+def employee_search_filters(args, scoped=False, dept_id=None, role=None):
+    clauses, params = [], []
+
+    q = args.get('q', '').strip()
+    if q:
+        prefix = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        clauses.append("(e.name LIKE %s OR e.email LIKE %s)")
+        params += [prefix, prefix]
+
+    if not scoped:
+        dept_id = args.get('department_id', type=int)
+    if scoped or dept_id is not None:
+        clauses.append("e.department_id = %s")
+        params.append(dept_id)
+
+    position = args.get('position', '').strip()
+    if position:
+        clauses.append("e.position = %s")
+        params.append(position)
+
+    role = role or args.get('role', '').strip()
+    if role:
+        if role not in ('admin', 'hr', 'employee'):
+            raise ValueError(f"Unknown role: {role}")
+        clauses.append("e.role = %s")
+        params.append(role)
+
+    for arg, op in (('joined_from', '>='), ('joined_to', '<=')):
+        value = args.get(arg, '').strip()
+        if value:
+            clauses.append(f"e.joining_date {op} %s")
+            params.append(datetime.strptime(value, '%Y-%m-%d').date())
+
+    sql = EMPLOYEE_SEARCH_SQL + ''.join(f" AND {clause}" for clause in clauses)
+    return sql, params
+
+def search_employees(cursor, args, scoped=False, dept_id=None, role=None):
+    sql, params = employee_search_filters(args, scoped, dept_id, role)
+    return keyset_page(cursor, sql, params, 'e.name', 'e.id', descending=False)
+
+# ========== AUTHENTICATION ==========
+
+class HashPoolBusy(Exception):
+    pass
+
+# Password hashing runs on a small thread pool (hashlib releases the GIL while hashing),
+# so a login storm uses at most PASSWORD_HASH_WORKERS cores. Requests beyond the queue
+# limit are turned away instead of piling up behind the workers.
+_hash_executor = None
+_hash_slots = None
+_hash_executor_pid = None
+_hash_executor_lock = threading.Lock()
+
+def run_hash_job(fn, *args):
+    global _hash_executor, _hash_slots, _hash_executor_pid
+    with _hash_executor_lock:
+        if _hash_executor is None or _hash_executor_pid != os.getpid():
+            workers = app.config['PASSWORD_HASH_WORKERS']
+            _hash_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+            _hash_slots = threading.BoundedSemaphore(workers + app.config['PASSWORD_HASH_QUEUE'])
+            _hash_executor_pid = os.getpid()
+        executor, slots = _hash_executor, _hash_slots
+
+    if not slots.acquire(timeout=app.config['PASSWORD_HASH_WAIT']):
+        raise HashPoolBusy()
+    try:
+        return executor.submit(fn, *args).result()
+    finally:
+        slots.release()
+
+def hash_password(password):
+    return run_hash_job(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+# werkzeug's defaults for parameters a method string may leave out
+PASSWORD_HASH_DEFAULTS = {'scrypt': ['32768', '8', '1'], 'pbkdf2': ['sha256', str(DEFAULT_PBKDF2_ITERATIONS)]}
+
+# 'scrypt', 'scrypt:32768' and 'scrypt:32768:8:1' all mean the same parameters
+def password_hash_params(method):
+    name, *params = method.split(':')
+    defaults = PASSWORD_HASH_DEFAULTS.get(name, [])
+    params += defaults[len(params):]
+    return (name,) + tuple(int(param) if param.isdigit() else param for param in params)
 
+def password_needs_rehash(password_hash):
+    return password_hash_params(password_hash.split('$', 1)[0]) != password_hash_params(app.config['PASSWORD_HASH_METHOD'])
 
+# Unknown emails are checked against this hash so they cost as much as a wrong password
+_dummy_password_hash = None
+
+def dummy_password_hash():
+    global _dummy_password_hash
+    if _dummy_password_hash is None or password_needs_rehash(_dummy_password_hash):
+        _dummy_password_hash = hash_password(os.urandom(16).hex())
+    return _dummy_password_hash
+
+def login_account_key(email):
+    return f"login:fail:account:{email.lower()}:{request.remote_addr}"
+
+def login_throttle_keys(email):
+    return [
+        (f"login:fail:ip:{request.remote_addr}", app.config['LOGIN_MAX_FAILURES_PER_IP']),
+        (login_account_key(email), app.config['LOGIN_MAX_FAILURES_PER_ACCOUNT'])
+    ]
+
+# Checked before any hashing, so a throttled flood costs one cache read per request
+def login_throttled(email):
+    return any((cache.get(key) or 0) >= limit for key, limit in login_throttle_keys(email))
+
+def record_login_failure(email):
+    for key, limit in login_throttle_keys(email):
+        cache.incr(key, ttl=app.config['LOGIN_THROTTLE_WINDOW'])
+
+# Look up the user and their employee record in one query and verify the password.
+# Returns the row on success, None on bad credentials; raises HashPoolBusy when the
+# hash workers are saturated.
+def authenticate(email, password):
+    cursor = get_db().cursor(dictionary=True)
+    cursor.execute("""
+        SELECT u.id, u.name, u.email, u.password, u.role,
+               e.id as emp_id, e.department_id, e.position
+        FROM users u
+        LEFT JOIN employees e ON e.user_id = u.id
+        WHERE u.email = %s
+    """, (email,))
+    user = cursor.fetchone()
+
+    if user is None:
+        run_hash_job(check_password_hash, dummy_password_hash(), password)
+        return None
+    if not run_hash_job(check_password_hash, user['password'], password):
+        return None
+
+    # Transparently move old hashes to the configured method while we have the plaintext;
+    # if the hash workers are busy the upgrade simply waits for a later login
+    if password_needs_rehash(user['password']):
+        try:
+            new_hash = hash_password(password)
+        except HashPoolBusy:
+            return user
+        cursor.execute("UPDATE users SET password = %s WHERE id = %s", (new_hash, user['id']))
+        get_db().commit()
+    return user
 
 # Home page
 @app.route('/')
@@ -60,30 +2156,30 @@ def login():
         email = request.form['email']
         password = request.form['password']
         
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
-        user = cursor.fetchone()
-        conn.close()
+        if login_throttled(email):
+            flash('Too many failed login attempts. Please try again later.', 'danger')
+            return render_template('login.html'), 429
+        
+        try:
+            user = authenticate(email, password)
+        except HashPoolBusy:
+            flash('The server is busy. Please try again in a moment.', 'warning')
+            return render_template('login.html'), 503
         
-        if user and check_password_hash(user['password'], password):
+        if user:
+            session.clear()
             session['user_id'] = user['id']
             session['user_name'] = user['name']
             session['user_email'] = user['email']
             session['role'] = user['role']
             
-            # Get employee info if exists
-            conn = get_db_connection()
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT * FROM employees WHERE user_id = %s", (user['id'],))
-            employee = cursor.fetchone()
-            conn.close()
-            
-            if employee:
-                session['emp_id'] = employee['id']
-                session['dept_id'] = employee['department_id']
-                session['position'] = employee['position']
+            # Employee info comes from the same query
+            if user['emp_id']:
+                session['emp_id'] = user['emp_id']
+                session['dept_id'] = user['department_id']
+                session['position'] = user['position']
             
+            cache.delete(login_account_key(email))
             log_audit('Login', f"User {user['email']} logged in successfully")
             flash('Login successful!', 'success')
             
@@ -94,6 +2190,7 @@ def login():
             else:
                 return redirect(url_for('employee_dashboard'))
         else:
+            record_login_failure(email)
             flash('Invalid email or password!', 'danger')
     
     return render_template('login.html')
@@ -104,46 +2201,19 @@ def register():
     if request.method == 'POST':
         name = request.form['name']
         email = request.form['email']
-        password = generate_password_hash(request.form['password'])
         role = request.form['role']
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Check if email already exists
-        cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
-        if cursor.fetchone():
+        # New accounts start in their role's default department
+        account = new_account(name, email, role, department_id=default_department_id(role))
+        try:
+            provision_account(get_db(), account, hash_password(request.form['password']))
+        except HashPoolBusy:
+            flash('The server is busy. Please try again in a moment.', 'warning')
+            return render_template('register.html'), 503
+        except DuplicateEmail:
             flash('Email already registered!', 'danger')
             return redirect(url_for('register'))
         
-        # Insert user
-        cursor.execute("""
-            INSERT INTO users (name, email, password, role) 
-            VALUES (%s, %s, %s, %s)
-        """, (name, email, password, role))
-        
-        user_id = cursor.lastrowid
-        
-        # Assign default department based on role
-        if role == 'hr':
-            cursor.execute("SELECT id FROM departments WHERE name = 'Human Resources'")
-        elif role == 'employee':
-            cursor.execute("SELECT id FROM departments WHERE name = 'IT'")
-        else:
-            cursor.execute("SELECT id FROM departments LIMIT 1")
-        
-        dept_result = cursor.fetchone()
-        dept_id = dept_result[0] if dept_result else 1
-        
-        # Insert employee record
-        cursor.execute("""
-            INSERT INTO employees (user_id, name, email, department_id, role) 
-            VALUES (%s, %s, %s, %s, %s)
-        """, (user_id, name, email, dept_id, role))
-        
-        conn.commit()
-        conn.close()
-        
         # We can't log audit here easily because user isn't logged in, but we could log system action if we wanted.
         # For now, let's skip or log as 'System' if we had a way.
         
@@ -191,21 +2261,25 @@ def change_password():
             flash('New passwords do not match!', 'danger')
             return redirect(url_for('change_password'))
             
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor(dictionary=True)
         cursor.execute("SELECT password FROM users WHERE id = %s", (session['user_id'],))
         user = cursor.fetchone()
         
-        if user and check_password_hash(user['password'], current_password):
-            hashed_password = generate_password_hash(new_password)
+        try:
+            valid = user and run_hash_job(check_password_hash, user['password'], current_password)
+            hashed_password = hash_password(new_password) if valid else None
+        except HashPoolBusy:
+            flash('The server is busy. Please try again in a moment.', 'warning')
+            return render_template('change_password.html'), 503
+        
+        if valid:
             cursor.execute("UPDATE users SET password = %s WHERE id = %s", (hashed_password, session['user_id']))
             conn.commit()
             log_audit('Change Password', f"User {session['user_email']} changed password")
             flash('Password updated successfully!', 'success')
-            conn.close()
             return redirect(url_for('profile'))
         else:
-            conn.close()
             flash('Incorrect current password!', 'danger')
             
     return render_template('change_password.html')
@@ -218,33 +2292,14 @@ def admin_dashboard():
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
-    # Get statistics
-    cursor.execute("SELECT COUNT(*) as count FROM employees WHERE role = 'employee'")
-    total_employees = cursor.fetchone()['count']
-    
-    cursor.execute("SELECT COUNT(*) as count FROM employees WHERE role = 'hr'")
-    total_hr = cursor.fetchone()['count']
-    
-    cursor.execute("SELECT COUNT(*) as count FROM departments")
-    total_departments = cursor.fetchone()['count']
-    
-    cursor.execute("SELECT COUNT(*) as count FROM attendance WHERE date = CURDATE()")
-    today_attendance = cursor.fetchone()['count']
-    
-    cursor.execute("SELECT COUNT(*) as count FROM leave_requests WHERE status = 'pending'")
-    pending_leaves = cursor.fetchone()['count']
-    
-    conn.close()
+    stats = get_dashboard_stats()
     
     return render_template('admin_dash.html',
-                         total_employees=total_employees,
-                         total_hr=total_hr,
-                         total_departments=total_departments,
-                         today_attendance=today_attendance,
-                         pending_leaves=pending_leaves)
+                         total_employees=stats['total_employees'],
+                         total_hr=stats['total_hr'],
+                         total_departments=stats['total_departments'],
+                         today_attendance=stats['today_attendance'],
+                         pending_leaves=stats['pending_leaves'])
 
 # Admin - Employees Management
 @app.route('/admin/employees')
@@ -252,27 +2307,53 @@ def admin_employees():
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
-    cursor.execute("""
-        SELECT e.*, d.name as department_name, u.email as user_email
-        FROM employees e
-        LEFT JOIN departments d ON e.department_id = d.id
-        LEFT JOIN users u ON e.user_id = u.id
-        WHERE e.role = 'employee'
-    """)
-    employees = cursor.fetchall()
+    try:
+        page = search_employees(cursor, request.args, role='employee')
+    except ValueError:
+        flash('Invalid search filter.', 'danger')
+        return redirect(url_for('admin_employees'))
     
     cursor.execute("SELECT id, name FROM departments")
     departments = cursor.fetchall()
     
-    conn.close()
-    
     return render_template('admin_employees.html',
-                         employees=employees,
+                         employees=page['rows'],
+                         page=page,
                          departments=departments)
 
+# Employee search API - paged JSON for admins (all departments) and HR (own department)
+@app.route('/api/employees/search')
+def employee_search_api():
+    if 'user_id' not in session or session['role'] not in ('admin', 'hr'):
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    # HR can only ever search their own department, whatever the query says
+    scoped = session['role'] == 'hr'
+    
+    conn = get_db()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        page = search_employees(cursor, request.args, scoped=scoped, dept_id=session.get('dept_id'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    employees = []
+    for row in page['rows']:
+        employee = {field: row[field] for field in EMPLOYEE_SEARCH_FIELDS}
+        employee['email'] = row['user_email'] or row['email']
+        employee['joining_date'] = row['joining_date'].isoformat() if row['joining_date'] else None
+        employees.append(employee)
+    
+    return jsonify({
+        'employees': employees,
+        'count': len(employees),
+        'next': page['next_url'],
+        'prev': page['prev_url']
+    })
+
 # Admin - Add Employee
 @app.route('/admin/employees/add', methods=['POST'])
 def add_employee():
@@ -289,29 +2370,49 @@ def add_employee():
     emergency_contact = request.form.get('emergency_contact', '')
     address = request.form.get('address', '')
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    account = new_account(name, email, 'employee', phone=phone, department_id=department_id, position=position,
+                          salary=salary, joining_date=joining_date, emergency_contact=emergency_contact, address=address)
+    try:
+        provision_account(get_db(), account, hash_password(DEFAULT_EMPLOYEE_PASSWORD))
+    except HashPoolBusy:
+        flash('The server is busy. Please try again in a moment.', 'warning')
+        return redirect(url_for('admin_employees'))
+    except DuplicateEmail:
+        flash(f'An account with email {email} already exists!', 'danger')
+        return redirect(url_for('admin_employees'))
     
-    # Create user account
-    password = generate_password_hash('password123')
-    cursor.execute("""
-        INSERT INTO users (name, email, password, role)
-        VALUES (%s, %s, %s, 'employee')
-    """, (name, email, password))
-    user_id = cursor.lastrowid
+    log_audit('Add User', f"Added employee {name} ({email})")
     
-    # Create employee record
-    cursor.execute("""
-        INSERT INTO employees (user_id, name, email, phone, department_id, position, salary, joining_date, emergency_contact, address, role)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'employee')
-    """, (user_id, name, email, phone, department_id, position, salary, joining_date, emergency_contact, address))
+    flash('Employee added successfully!', 'success')
+    return redirect(url_for('admin_employees'))
+
+# Admin - Bulk Onboarding (CSV or JSONL: name, email, phone, department, position, salary, joining_date, ...)
+@app.route('/admin/employees/bulk', methods=['POST'])
+def bulk_onboard_employees():
+    if 'user_id' not in session or session['role'] != 'admin':
+        return redirect(url_for('login'))
     
-    conn.commit()
-    conn.close()
+    file = request.files.get('file')
+    if not file or file.filename == '':
+        flash('No selected file', 'danger')
+        return redirect(url_for('admin_employees'))
     
-    log_audit('Add User', f"Added employee {name} ({email})")
+    try:
+        report = onboard_employees(get_db(), file.stream, import_format(file.filename))
+    except HashPoolBusy:
+        flash('The server is busy. Please try again in a moment.', 'warning')
+        return redirect(url_for('admin_employees'))
+    except mysql.connector.Error as e:
+        print(f"Onboarding import error: {e}")
+        flash('Import failed, no accounts were created.', 'danger')
+        return redirect(url_for('admin_employees'))
     
-    flash('Employee added successfully!', 'success')
+    log_audit('Bulk Onboarding', f"Created {report['created']} accounts from {file.filename} ({len(report['errors'])} errors)")
+    
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    
+    flash_import_report(report, f"Created {report['created']} employee accounts")
     return redirect(url_for('admin_employees'))
 
 # Admin - Edit Employee
@@ -324,20 +2425,35 @@ def edit_employee(emp_id):
     phone = request.form['phone']
     department_id = request.form['department_id']
     position = request.form.get('position', '')
-    salary = request.form['salary']
     address = request.form.get('address', '')
+    try:
+        salary = Decimal(request.form['salary']).quantize(Decimal('0.01'))
+    except (ValueError, InvalidOperation):
+        flash('Invalid salary value submitted.', 'danger')
+        return redirect(url_for('admin_employees'))
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     
+    # Remember the old department so both sides of a transfer get fresh counters
+    cursor.execute("SELECT department_id, user_id FROM employees WHERE id = %s", (emp_id,))
+    previous = cursor.fetchone()
+    
     cursor.execute("""
         UPDATE employees 
-        SET name = %s, phone = %s, department_id = %s, position = %s, salary = %s, address = %s
+        SET name = %s, phone = %s, department_id = %s, position = %s, address = %s
         WHERE id = %s
-    """, (name, phone, department_id, position, salary, address, emp_id))
+    """, (name, phone, department_id, position, address, emp_id))
+    # Salary goes through the shared path so the change lands in salary_history
+    if previous:
+        apply_salary_changes(cursor, {emp_id: salary}, session['user_id'])
     
+    bump_data_version(cursor, 'employees')
     conn.commit()
-    conn.close()
+    invalidate_department_headcounts()
+    invalidate_dashboard_stats(department_id, previous[0] if previous else None)
+    if previous:
+        invalidate_identity(previous[1])
     
     flash('Employee updated successfully!', 'success')
     return redirect(url_for('admin_employees'))
@@ -348,22 +2464,28 @@ def delete_employee(emp_id):
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     
     # Get user_id before deleting
-    cursor.execute("SELECT user_id FROM employees WHERE id = %s", (emp_id,))
+    cursor.execute("SELECT user_id, department_id FROM employees WHERE id = %s", (emp_id,))
     result = cursor.fetchone()
     
     if result:
         user_id = result[0]
+        doc_ids = release_user_documents(cursor, user_id)
         # Delete employee
         cursor.execute("DELETE FROM employees WHERE id = %s", (emp_id,))
         # Delete user
         cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
     
+    bump_data_version(cursor, 'employees')
     conn.commit()
-    conn.close()
+    if result:
+        invalidate_department_headcounts()
+        invalidate_dashboard_stats(result[1])
+        invalidate_identity(result[0])
+        invalidate_document_meta(*doc_ids)
     
     log_audit('Delete User', f"Deleted employee ID {emp_id}")
 
@@ -376,25 +2498,23 @@ def admin_hr_managers():
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
-    cursor.execute("""
+    page = keyset_page(cursor, """
         SELECT e.*, d.name as department_name, u.email as user_email
         FROM employees e
         LEFT JOIN departments d ON e.department_id = d.id
         LEFT JOIN users u ON e.user_id = u.id
         WHERE e.role = 'hr'
-    """)
-    hr_managers = cursor.fetchall()
+    """, (), 'e.name', 'e.id', descending=False)
     
     cursor.execute("SELECT id, name FROM departments")
     departments = cursor.fetchall()
     
-    conn.close()
-    
     return render_template('hr_managers.html',
-                         hr_managers=hr_managers,
+                         hr_managers=page['rows'],
+                         page=page,
                          departments=departments)
 
 # Admin - Add HR Manager
@@ -409,25 +2529,15 @@ def add_hr_manager():
     department_id = request.form.get('department_id')
     address = request.form.get('address', '')
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Create user account
-    password = generate_password_hash('hrpassword123')
-    cursor.execute("""
-        INSERT INTO users (name, email, password, role)
-        VALUES (%s, %s, %s, 'hr')
-    """, (name, email, password))
-    user_id = cursor.lastrowid
-    
-    # Create HR manager record
-    cursor.execute("""
-        INSERT INTO employees (user_id, name, email, phone, department_id, address, role)
-        VALUES (%s, %s, %s, %s, %s, %s, 'hr')
-    """, (user_id, name, email, phone, department_id, address))
-    
-    conn.commit()
-    conn.close()
+    account = new_account(name, email, 'hr', phone=phone, department_id=department_id, address=address)
+    try:
+        provision_account(get_db(), account, hash_password(DEFAULT_HR_PASSWORD))
+    except HashPoolBusy:
+        flash('The server is busy. Please try again in a moment.', 'warning')
+        return redirect(url_for('admin_hr_managers'))
+    except DuplicateEmail:
+        flash(f'An account with email {email} already exists!', 'danger')
+        return redirect(url_for('admin_hr_managers'))
     
     flash('HR Manager added successfully!', 'success')
     return redirect(url_for('admin_hr_managers'))
@@ -438,7 +2548,7 @@ def delete_hr_manager(hr_id):
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     
     # Get user_id before deleting
@@ -447,13 +2557,19 @@ def delete_hr_manager(hr_id):
     
     if result:
         user_id = result[0]
+        doc_ids = release_user_documents(cursor, user_id)
         # Delete HR manager record
         cursor.execute("DELETE FROM employees WHERE id = %s", (hr_id,))
         # Delete user record
         cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
     
+    bump_data_version(cursor, 'employees')
     conn.commit()
-    conn.close()
+    invalidate_department_headcounts()
+    invalidate_dashboard_stats()
+    if result:
+        invalidate_identity(result[0])
+        invalidate_document_meta(*doc_ids)
     
     flash('HR Manager deleted successfully!', 'success')
     return redirect(url_for('admin_hr_managers'))
@@ -464,22 +2580,16 @@ def admin_departments():
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
-    # Get departments with employee count
-    cursor.execute("""
-        SELECT d.*, 
-               (SELECT COUNT(*) FROM employees e WHERE e.department_id = d.id) as employee_count
-        FROM departments d
-    """)
+    cursor.execute("SELECT * FROM departments")
     departments = cursor.fetchall()
     
-    # Get total employees for utilization calc
-    cursor.execute("SELECT COUNT(*) as count FROM employees")
-    total_employees = cursor.fetchone()['count']
-    
-    conn.close()
+    # Employee counts come from the cached headcounts instead of a subquery per department
+    for d in departments:
+        d['employee_count'] = department_headcount(d['id'])
+    total_employees = company_headcount()
     
     return render_template('department_management.html',
                          departments=departments,
@@ -497,7 +2607,7 @@ def add_department():
     location = request.form.get('location')
     description = request.form.get('description')
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -506,7 +2616,8 @@ def add_department():
     """, (name, manager_id if manager_id else None, budget, location, description))
     
     conn.commit()
-    conn.close()
+    invalidate_department_ids()
+    invalidate_dashboard_stats()
     
     log_audit('Add Department', f"Created department {name}")
     flash('Department added successfully!', 'success')
@@ -524,7 +2635,7 @@ def edit_department(dept_id):
     location = request.form.get('location')
     description = request.form.get('description')
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -533,8 +2644,9 @@ def edit_department(dept_id):
         WHERE id = %s
     """, (name, manager_id if manager_id else None, budget, location, description, dept_id))
     
+    bump_data_version(cursor, 'departments')
     conn.commit()
-    conn.close()
+    invalidate_department_ids()
     
     log_audit('Edit Department', f"Updated department {dept_id}")
     flash('Department updated successfully!', 'success')
@@ -546,22 +2658,21 @@ def delete_department(dept_id):
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     
-    # Check if there are employees in this department
-    cursor.execute("SELECT COUNT(*) FROM employees WHERE department_id = %s", (dept_id,))
-    count = cursor.fetchone()[0]
-    
-    if count > 0:
+    # Check if there are employees in this department (never trust a cached count here)
+    if department_headcount(dept_id, fresh=True) > 0:
         flash('Cannot delete department with employees! Move them first.', 'danger')
     else:
         cursor.execute("DELETE FROM departments WHERE id = %s", (dept_id,))
+        invalidate_department_ids()
+        invalidate_dashboard_stats(dept_id)
         log_audit('Delete Department', f"Deleted department {dept_id}")
         flash('Department deleted successfully!', 'success')
     
+    bump_data_version(cursor, 'departments')
     conn.commit()
-    conn.close()
     
     return redirect(url_for('admin_departments'))
 
@@ -573,44 +2684,38 @@ def set_salary():
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
-    cursor.execute("""
+    page = keyset_page(cursor, """
         SELECT e.*, d.name as department
         FROM employees e
         LEFT JOIN departments d ON e.department_id = d.id
         WHERE e.role = 'employee'
-    """)
-    employees = cursor.fetchall()
-    
-    conn.close()
+    """, (), 'e.name', 'e.id', descending=False)
     
-    return render_template('set_salary.html', employees=employees)
+    return render_template('set_salary.html', employees=page['rows'], page=page)
 
 @app.route('/admin/payroll/set-salary', methods=['POST'])
 def update_salary():
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    new_salaries = {}
+    try:
+        for key, value in request.form.items():
+            if key.startswith('salary_') and value.strip():
+                new_salaries[int(key.split('_')[1])] = Decimal(value).quantize(Decimal('0.01'))
+    except (ValueError, InvalidOperation):
+        flash('Invalid salary value submitted.', 'danger')
+        return redirect(url_for('set_salary'))
     
-    updates_count = 0
+    conn = get_db()
+    cursor = conn.cursor()
     
     try:
-        for key, value in request.form.items():
-            if key.startswith('salary_'):
-                emp_id = key.split('_')[1]
-                new_salary = value
-                
-                cursor.execute("""
-                    UPDATE employees 
-                    SET salary = %s
-                    WHERE id = %s
-                """, (new_salary, emp_id))
-                updates_count += 1
-        
+        updates_count = apply_salary_changes(cursor, new_salaries, session['user_id'])
+        bump_data_version(cursor, 'employees')
         conn.commit()
         if updates_count > 0:
             log_audit('Update Salary', f"Updated salaries for {updates_count} employees")
@@ -622,8 +2727,6 @@ def update_salary():
         conn.rollback()
         print(f"Salary update error: {e}")
         flash('An error occurred while updating salaries.', 'danger')
-    finally:
-        conn.close()
     
     return redirect(url_for('set_salary'))
 
@@ -635,7 +2738,7 @@ def admin_attendance():
     
     filter_date = request.args.get('date', date.today().isoformat())
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
     cursor.execute("""
@@ -659,8 +2762,6 @@ def admin_attendance():
     """, (filter_date,))
     stats = cursor.fetchone()
     
-    conn.close()
-    
     return render_template('hr_attendance.html',
                          attendance_list=attendance_list,
                          stats=stats,
@@ -673,15 +2774,18 @@ def admin_leave_requests():
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
     cursor.execute("""
         SELECT lr.*, e.name as employee_name, e.position, d.name as department,
-               DATEDIFF(lr.end_date, lr.start_date) + 1 as total_days
+               DATEDIFF(lr.end_date, lr.start_date) + 1 as total_days,
+               b.entitled - b.used - b.pending as balance_after
         FROM leave_requests lr
         JOIN employees e ON lr.employee_id = e.id
         LEFT JOIN departments d ON e.department_id = d.id
+        LEFT JOIN leave_balances b
+            ON b.employee_id = lr.employee_id AND b.leave_type = lr.leave_type AND b.year = YEAR(lr.start_date)
         WHERE lr.status = 'pending'
         ORDER BY lr.start_date DESC
     """)
@@ -698,8 +2802,6 @@ def admin_leave_requests():
     """)
     leave_stats = cursor.fetchone()
     
-    conn.close()
-    
     return render_template('hr_leave_requests.html', 
                          leave_requests=leave_requests, 
                          leave_stats=leave_stats,
@@ -711,9 +2813,10 @@ def admin_payroll():
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
     
-    month = request.args.get('month', date.today().strftime('%Y-%m'))
+    month_start, month_end = month_bounds(request.args.get('month'))
+    month = month_start.strftime('%Y-%m')
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
     cursor.execute("""
@@ -721,14 +2824,32 @@ def admin_payroll():
         FROM payroll p
         JOIN employees e ON p.employee_id = e.id
         LEFT JOIN departments d ON e.department_id = d.id
-        WHERE DATE_FORMAT(p.month_year, '%Y-%m') = %s
+        WHERE p.month_year >= %s AND p.month_year < %s
         ORDER BY d.name, e.name
-    """, (month,))
+    """, (month_start, month_end))
     slips = cursor.fetchall()
     
-    conn.close()
+    return render_template('hr_payroll_slips.html', slips=slips, selected_month=month, is_admin=True)
+
+# Admin - Run Payroll
+@app.route('/admin/payroll/run', methods=['POST'])
+def run_payroll_route():
+    if 'user_id' not in session or session['role'] != 'admin':
+        return redirect(url_for('login'))
+    
+    month_start, _ = month_bounds(request.form.get('month'))
     
-    return render_template('hr_payroll_slips.html', slips=slips, selected_month=month, is_admin=True)
+    try:
+        result = run_payroll(get_db(), month_start)
+    except mysql.connector.Error as e:
+        print(f"Payroll run error: {e}")
+        flash('Payroll generation failed, no payslips were changed.', 'danger')
+        return redirect(url_for('admin_payroll', month=month_start.strftime('%Y-%m')))
+    
+    log_audit('Run Payroll', f"Generated payroll for {result['month']}: {result['payslips']} payslips")
+    flash(f"Payroll for {result['month']} generated: {result['payslips']} payslips "
+          f"({result['paid']} already paid, left unchanged).", 'success')
+    return redirect(url_for('admin_payroll', month=result['month']))
 
 # ========== HR ROUTES ==========
 
@@ -740,31 +2861,10 @@ def hr_dashboard():
     
     dept_id = session.get('dept_id', 0)
     
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
-    # Department employees count
-    cursor.execute("""
-        SELECT COUNT(*) as count FROM employees 
-        WHERE department_id = %s AND role = 'employee'
-    """, (dept_id,))
-    dept_employees = cursor.fetchone()['count']
-    
-    # Today's attendance count
-    cursor.execute("""
-        SELECT COUNT(*) as count FROM attendance a
-        JOIN employees e ON a.employee_id = e.id
-        WHERE a.date = CURDATE() AND e.department_id = %s
-    """, (dept_id,))
-    today_attendance = cursor.fetchone()['count']
+    stats = get_dashboard_stats(dept_id or 0)
     
-    # Pending leaves
-    cursor.execute("""
-        SELECT COUNT(*) as count FROM leave_requests lr
-        JOIN employees e ON lr.employee_id = e.id
-        WHERE lr.status = 'pending' AND e.department_id = %s
-    """, (dept_id,))
-    pending_leaves = cursor.fetchone()['count']
+    conn = get_db()
+    cursor = conn.cursor(dictionary=True)
     
     # Department attendance
     cursor.execute("""
@@ -776,12 +2876,10 @@ def hr_dashboard():
     """, (dept_id,))
     dept_attendance = cursor.fetchall()
     
-    conn.close()
-    
     return render_template('hr_dash.html',
-                         dept_employees=dept_employees,
-                         today_attendance=today_attendance,
-                         pending_leaves=pending_leaves,
+                         dept_employees=stats['dept_employees'],
+                         today_attendance=stats['today_attendance'],
+                         pending_leaves=stats['pending_leaves'],
                          dept_attendance=dept_attendance)
 
 # HR - Employees List
@@ -790,22 +2888,17 @@ def hr_employees():
     if 'user_id' not in session or session['role'] != 'hr':
         return redirect(url_for('login'))
     
-    dept_id = session.get('dept_id', 0)
-    
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
-    cursor.execute("""
-        SELECT e.*, d.name as department_name
-        FROM employees e
-        LEFT JOIN departments d ON e.department_id = d.id
-        WHERE e.department_id = %s AND e.role = 'employee'
-    """, (dept_id,))
-    employees = cursor.fetchall()
-    
-    conn.close()
+    try:
+        page = search_employees(cursor, request.args, scoped=True, dept_id=session.get('dept_id'),
+                                role='employee')
+    except ValueError:
+        flash('Invalid search filter.', 'danger')
+        return redirect(url_for('hr_employees'))
     
-    return render_template('employees.html', employees=employees)
+    return render_template('employees.html', employees=page['rows'], page=page)
 
 # HR - Update Employee
 @app.route('/hr/employees/update/<int:emp_id>', methods=['POST'])
@@ -816,7 +2909,7 @@ def hr_update_employee(emp_id):
     phone = request.form['phone']
     address = request.form['address']
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -826,7 +2919,6 @@ def hr_update_employee(emp_id):
     """, (phone, address, emp_id))
     
     conn.commit()
-    conn.close()
     
     flash('Employee details updated successfully!', 'success')
     return redirect(url_for('hr_employees'))
@@ -840,7 +2932,7 @@ def hr_attendance():
     dept_id = session.get('dept_id', 0)
     filter_date = request.args.get('date', date.today().isoformat())
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
     cursor.execute("""
@@ -865,8 +2957,6 @@ def hr_attendance():
     """, (filter_date, dept_id))
     stats = cursor.fetchone()
     
-    conn.close()
-    
     return render_template('hr_attendance.html',
                          attendance_list=attendance_list,
                          stats=stats,
@@ -883,39 +2973,22 @@ def hr_manual_attendance():
     if request.method == 'POST':
         employee_id = request.form['employee_id']
         att_date = request.form['date']
-        check_in = request.form.get('check_in')
-        check_out = request.form.get('check_out')
-        status = request.form['status']
+        check_in = request.form.get('check_in') or None
+        check_out = request.form.get('check_out') or None
+        status = normalize_attendance_status(request.form['status'])
         
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor()
         
-        # Check if record exists
-        cursor.execute("""
-            SELECT id FROM attendance 
-            WHERE employee_id = %s AND date = %s
-        """, (employee_id, att_date))
-        existing = cursor.fetchone()
-        
-        if existing:
-            cursor.execute("""
-                UPDATE attendance 
-                SET check_in = %s, check_out = %s, status = %s
-                WHERE id = %s
-            """, (check_in, check_out, status, existing[0]))
-        else:
-            cursor.execute("""
-                INSERT INTO attendance (employee_id, date, check_in, check_out, status)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (employee_id, att_date, check_in, check_out, status))
-        
+        upsert_attendance(cursor, employee_id, att_date, check_in, check_out, status)
+        bump_data_version(cursor, 'attendance')
         conn.commit()
-        conn.close()
+        invalidate_dashboard_stats(dept_id)
         
         flash('Attendance updated successfully!', 'success')
         return redirect(url_for('hr_manual_attendance'))
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
     cursor.execute("""
@@ -925,10 +2998,39 @@ def hr_manual_attendance():
     """, (dept_id,))
     employees = cursor.fetchall()
     
-    conn.close()
-    
     return render_template('hr_manual_attendance.html', employees=employees)
 
+# HR/Admin - Bulk Attendance Import (CSV or JSONL: employee_id, date, check_in, check_out, status)
+@app.route('/hr/attendance/bulk', methods=['POST'])
+def bulk_attendance_import():
+    if 'user_id' not in session or session['role'] not in ['admin', 'hr']:
+        return redirect(url_for('login'))
+    
+    file = request.files.get('file')
+    if not file or file.filename == '':
+        flash('No selected file', 'danger')
+        return redirect(url_for('hr_manual_attendance'))
+    
+    # HR can only import for their own department
+    scoped = session['role'] == 'hr'
+    dept_id = session.get('dept_id') if scoped else None
+    
+    try:
+        report = import_attendance(get_db(), file.stream, import_format(file.filename), scoped, dept_id)
+    except mysql.connector.Error as e:
+        print(f"Attendance import error: {e}")
+        flash('Import failed, no rows were saved.', 'danger')
+        return redirect(url_for('hr_manual_attendance'))
+    
+    invalidate_dashboard_stats(dept_id)
+    log_audit('Bulk Attendance Import', f"Imported {report['imported']} rows from {file.filename} ({len(report['errors'])} errors)")
+    
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    
+    flash_import_report(report, f"Imported {report['imported']} attendance rows")
+    return redirect(url_for('hr_manual_attendance'))
+
 # HR - Leave Requests
 @app.route('/hr/leave-requests')
 def hr_leave_requests():
@@ -937,15 +3039,18 @@ def hr_leave_requests():
     
     dept_id = session.get('dept_id', 0)
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
     cursor.execute("""
         SELECT lr.*, e.name as employee_name, e.position, d.name as department,
-               DATEDIFF(lr.end_date, lr.start_date) + 1 as total_days
+               DATEDIFF(lr.end_date, lr.start_date) + 1 as total_days,
+               b.entitled - b.used - b.pending as balance_after
         FROM leave_requests lr
         JOIN employees e ON lr.employee_id = e.id
         LEFT JOIN departments d ON e.department_id = d.id
+        LEFT JOIN leave_balances b
+            ON b.employee_id = lr.employee_id AND b.leave_type = lr.leave_type AND b.year = YEAR(lr.start_date)
         WHERE e.department_id = %s AND lr.status = 'pending'
         ORDER BY lr.start_date DESC
     """, (dept_id,))
@@ -964,8 +3069,6 @@ def hr_leave_requests():
     """, (dept_id,))
     leave_stats = cursor.fetchone()
     
-    conn.close()
-    
     return render_template('hr_leave_requests.html', 
                          leave_requests=leave_requests,
                          leave_stats=leave_stats)
@@ -973,35 +3076,100 @@ def hr_leave_requests():
 # HR - Leave Action
 @app.route('/hr/leave/action/<int:leave_id>', methods=['POST'])
 def hr_leave_action(leave_id):
-    if 'user_id' not in session or session['role'] != 'hr':
+    if 'user_id' not in session or session['role'] not in ['admin', 'hr']:
         return redirect(url_for('login'))
     
     action = request.form['action']
+    queue = 'admin_leave_requests' if session['role'] == 'admin' else 'hr_leave_requests'
+    if action not in ('approve', 'reject'):
+        return redirect(url_for(queue))
+    
+    # HR can only decide requests from their own department
+    scoped = session['role'] == 'hr'
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
+    decided = decide_leave_requests(cursor, [leave_id], action == 'approve', session['user_id'],
+                                    scoped, session.get('dept_id'))
+    if not decided:
+        flash('This leave request has already been processed.', 'warning')
+        return redirect(url_for(queue))
+    
+    conn.commit()
+    invalidate_dashboard_stats(decided[0][1])
+    invalidate_notification_counts(decided[0][2])
     
     if action == 'approve':
-        cursor.execute("""
-            UPDATE leave_requests 
-            SET status = 'approved', approved_by = %s, approved_date = NOW()
-            WHERE id = %s
-        """, (session['user_id'], leave_id))
         flash('Leave approved successfully!', 'success')
         log_audit('Leave Action', f"Approved leave request {leave_id}")
-    elif action == 'reject':
-        cursor.execute("""
-            UPDATE leave_requests 
-            SET status = 'rejected', approved_by = %s, approved_date = NOW()
-            WHERE id = %s
-        """, (session['user_id'], leave_id))
+    else:
         flash('Leave rejected!', 'success')
         log_audit('Leave Action', f"Rejected leave request {leave_id}")
     
-    conn.commit()
-    conn.close()
+    return redirect(url_for(queue))
+
+# HR/Admin - Bulk Leave Action (form: leave_ids + action, or JSON: {"ids": [...], "action": ...})
+@app.route('/hr/leave/bulk-action', methods=['POST'])
+def bulk_leave_action():
+    if 'user_id' not in session or session['role'] not in ['admin', 'hr']:
+        return redirect(url_for('login'))
     
-    return redirect(url_for('hr_leave_requests'))
+    queue = 'admin_leave_requests' if session['role'] == 'admin' else 'hr_leave_requests'
+    is_json = request.is_json
+    
+    def invalid(message):
+        if is_json:
+            return jsonify({'error': message}), 400
+        flash(message, 'warning')
+        return redirect(url_for(queue))
+    
+    if is_json:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return invalid("Expected a JSON object with 'ids' and 'action'")
+        ids, action = data.get('ids'), data.get('action')
+        if not isinstance(ids, list) or not all(type(leave_id) is int for leave_id in ids):
+            return invalid("'ids' must be a list of integer leave request ids")
+    else:
+        action = request.form.get('action')
+        try:
+            ids = [int(leave_id) for leave_id in request.form.getlist('leave_ids')]
+        except ValueError:
+            return invalid('Invalid leave request id.')
+    
+    leave_ids = sorted(set(ids))
+    if action not in ('approve', 'reject'):
+        return invalid("Action must be 'approve' or 'reject'.")
+    if not leave_ids:
+        return invalid('Select at least one leave request.')
+    if len(leave_ids) > app.config['BULK_CHUNK_SIZE']:
+        return invalid(f"At most {app.config['BULK_CHUNK_SIZE']} leave requests can be decided at once.")
+    
+    # HR can only decide requests from their own department
+    scoped = session['role'] == 'hr'
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    decided = decide_leave_requests(cursor, leave_ids, action == 'approve', session['user_id'],
+                                    scoped, session.get('dept_id'))
+    conn.commit()
+    invalidate_dashboard_stats(*{department_id for leave_id, department_id, user_id in decided})
+    invalidate_notification_counts(*[user_id for leave_id, department_id, user_id in decided])
+    
+    # One audit event per request; the audit writer inserts them as one batch
+    verb = 'Approved' if action == 'approve' else 'Rejected'
+    for leave_id, department_id, user_id in decided:
+        log_audit('Leave Action', f"{verb} leave request {leave_id}")
+    
+    decided_ids = [leave_id for leave_id, department_id, user_id in decided]
+    skipped = sorted(set(leave_ids) - set(decided_ids))
+    if is_json:
+        return jsonify({'action': action, 'decided': decided_ids, 'skipped': skipped})
+    
+    flash(f"{verb} {len(decided_ids)} leave request(s).", 'success')
+    if skipped:
+        flash(f"{len(skipped)} request(s) skipped (already processed or outside your department).", 'warning')
+    return redirect(url_for(queue))
 
 # HR - Payroll Slips
 @app.route('/hr/payroll')
@@ -1010,9 +3178,10 @@ def hr_payroll_slips():
         return redirect(url_for('login'))
     
     dept_id = session.get('dept_id', 0)
-    month = request.args.get('month', date.today().strftime('%Y-%m'))
+    month_start, month_end = month_bounds(request.args.get('month'))
+    month = month_start.strftime('%Y-%m')
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
     cursor.execute("""
@@ -1020,12 +3189,10 @@ def hr_payroll_slips():
         FROM payroll p
         JOIN employees e ON p.employee_id = e.id
         WHERE e.department_id = %s
-        AND DATE_FORMAT(p.month_year, '%Y-%m') = %s
-    """, (dept_id, month))
+        AND p.month_year >= %s AND p.month_year < %s
+    """, (dept_id, month_start, month_end))
     slips = cursor.fetchall()
     
-    conn.close()
-    
     return render_template('hr_payroll_slips.html', slips=slips, selected_month=month)
 
 # ========== EMPLOYEE ROUTES ==========
@@ -1038,7 +3205,7 @@ def employee_dashboard():
     
     emp_id = session.get('emp_id', 0)
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
     # Today's status
@@ -1049,12 +3216,13 @@ def employee_dashboard():
     today_status = cursor.fetchone()
     
     # Present days this month
+    month_start, month_end = month_bounds()
     cursor.execute("""
         SELECT COUNT(*) as count FROM attendance 
         WHERE employee_id = %s 
-        AND MONTH(date) = MONTH(CURDATE())
+        AND date >= %s AND date < %s
         AND status = 'present'
-    """, (emp_id,))
+    """, (emp_id, month_start, month_end))
     present_days = cursor.fetchone()['count']
     
     # Recent attendance
@@ -1067,8 +3235,6 @@ def employee_dashboard():
     """, (emp_id,))
     recent_attendance = cursor.fetchall()
     
-    conn.close()
-    
     stats = {
         'today_status': today_status['status'] if today_status else 'Not Marked',
         'present_days': present_days
@@ -1087,46 +3253,39 @@ def mark_attendance():
     emp_id = session.get('emp_id', 0)
     today = date.today()
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
-    # Check today's record
-    cursor.execute("""
-        SELECT * FROM attendance 
-        WHERE employee_id = %s AND date = %s
-    """, (emp_id, today))
-    today_record = cursor.fetchone()
-    
     if request.method == 'POST':
         action = request.form.get('action')
+        now_time = datetime.now().strftime('%H:%M:%S')
         
         if action == 'check_in':
-            check_in_time = datetime.now().strftime('%H:%M:%S')
-            
-            if today_record:
-                flash('Already checked in today!', 'warning')
-            else:
-                cursor.execute("""
-                    INSERT INTO attendance (employee_id, date, check_in, status)
-                    VALUES (%s, %s, %s, 'present')
-                """, (emp_id, today, check_in_time))
+            if check_in_attendance(cursor, emp_id, today, now_time):
+                bump_data_version(cursor, 'attendance')
+                conn.commit()
+                invalidate_dashboard_stats(session.get('dept_id'))
                 flash('Checked in successfully!', 'success')
+            else:
+                flash('Already checked in today!', 'warning')
         
         elif action == 'check_out':
-            if today_record and not today_record['check_out']:
-                check_out_time = datetime.now().strftime('%H:%M:%S')
-                cursor.execute("""
-                    UPDATE attendance 
-                    SET check_out = %s
-                    WHERE id = %s
-                """, (check_out_time, today_record['id']))
+            if check_out_attendance(cursor, emp_id, today, now_time):
+                bump_data_version(cursor, 'attendance')
+                conn.commit()
                 flash('Checked out successfully!', 'success')
-            elif today_record and today_record['check_out']:
-                flash('Already checked out today!', 'warning')
+            else:
+                flash('Already checked out today (or not checked in yet)!', 'warning')
         
-        conn.commit()
         return redirect(url_for('mark_attendance'))
     
+    # Check today's record
+    cursor.execute("""
+        SELECT * FROM attendance 
+        WHERE employee_id = %s AND date = %s
+    """, (emp_id, today))
+    today_record = cursor.fetchone()
+    
     # Attendance history
     cursor.execute("""
         SELECT date, check_in, check_out, status, 
@@ -1139,15 +3298,15 @@ def mark_attendance():
     attendance_history = cursor.fetchall()
     
     # Calculate Monthly Summary
-    current_month = date.today().month
+    month_start, month_end = month_bounds()
     cursor.execute("""
         SELECT 
             COUNT(CASE WHEN status = 'Present' THEN 1 END) as present_days,
             COUNT(CASE WHEN status = 'Absent' THEN 1 END) as absent_days,
             SUM(TIMESTAMPDIFF(HOUR, check_in, check_out)) as total_hours
         FROM attendance 
-        WHERE employee_id = %s AND MONTH(date) = %s
-    """, (emp_id, current_month))
+        WHERE employee_id = %s AND date >= %s AND date < %s
+    """, (emp_id, month_start, month_end))
     summary_data = cursor.fetchone()
     
     monthly_summary = {
@@ -1157,8 +3316,6 @@ def mark_attendance():
         'overtime_hours': 0 # simplified for now
     }
     
-    conn.close()
-    
     return render_template('mark_attendance.html',
                          today_record=today_record,
                          attendance_history=attendance_history,
@@ -1173,14 +3330,30 @@ def apply_leave():
     
     emp_id = session.get('emp_id', 0)
     
+    conn = get_db()
+    cursor = conn.cursor(dictionary=True)
+    leave_types = get_leave_types()
+    
     if request.method == 'POST':
         leave_type = request.form.get('leave_type')
-        start_date = request.form.get('start_date')
-        end_date = request.form.get('end_date')
         reason = request.form.get('reason')
+        try:
+            start_date = date.fromisoformat(request.form.get('start_date', ''))
+            end_date = date.fromisoformat(request.form.get('end_date', ''))
+        except ValueError:
+            flash('Please enter valid leave dates!', 'danger')
+            return redirect(url_for('apply_leave'))
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        if leave_type not in leave_types or end_date < start_date:
+            flash('Invalid leave type or date range!', 'danger')
+            return redirect(url_for('apply_leave'))
+        
+        # Reserve the days first; the insert below is not counted by a first-time accrual
+        if not reserve_leave(cursor, emp_id, leave_type, start_date, end_date):
+            conn.rollback()
+            flash(f"Not enough {leave_types[leave_type]['name']} balance for "
+                  f"{leave_days(start_date, end_date)} day(s)!", 'danger')
+            return redirect(url_for('apply_leave'))
         
         cursor.execute("""
             INSERT INTO leave_requests (employee_id, leave_type, start_date, end_date, reason, status)
@@ -1188,12 +3361,15 @@ def apply_leave():
         """, (emp_id, leave_type, start_date, end_date, reason))
         
         conn.commit()
-        conn.close()
+        invalidate_dashboard_stats(session.get('dept_id'))
         
         flash('Leave application submitted successfully!', 'success')
         return redirect(url_for('my_leaves'))
     
-    return render_template('apply_leave.html')
+    balances = get_leave_balances(cursor, emp_id, date.today().year)
+    conn.commit()
+    
+    return render_template('apply_leave.html', leave_types=leave_types.values(), balances=balances)
 
 # My Leaves
 @app.route('/leave/my-leaves')
@@ -1203,19 +3379,21 @@ def my_leaves():
     
     emp_id = session.get('emp_id', 0)
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
     cursor.execute("""
-        SELECT * FROM leave_requests 
+        SELECT *, DATEDIFF(end_date, start_date) + 1 as total_days, applied_on as applied_date
+        FROM leave_requests 
         WHERE employee_id = %s 
         ORDER BY start_date DESC
     """, (emp_id,))
     leaves = cursor.fetchall()
     
-    conn.close()
+    balances = get_leave_balances(cursor, emp_id, date.today().year)
+    conn.commit()
     
-    return render_template('my_leaves.html', leaves=leaves)
+    return render_template('my_leaves.html', leaves=leaves, balances=balances)
 
 # My Payroll Slips
 @app.route('/payroll/my-slips')
@@ -1225,7 +3403,7 @@ def my_payroll_slips():
     
     emp_id = session.get('emp_id', 0)
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
     cursor.execute("""
@@ -1237,8 +3415,6 @@ def my_payroll_slips():
     """, (emp_id,))
     slips = cursor.fetchall()
     
-    conn.close()
-    
     return render_template('my_payroll_slips.html', slips=slips)
 
 # Profile
@@ -1249,7 +3425,7 @@ def profile():
     
     emp_id = session.get('emp_id', 0)
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
     cursor.execute("""
@@ -1260,8 +3436,6 @@ def profile():
     """, (emp_id,))
     profile = cursor.fetchone()
     
-    conn.close()
-    
     return render_template('profile.html', profile=profile)
 
 # Update Profile
@@ -1275,7 +3449,7 @@ def update_profile():
     address = request.form['address']
     emergency_contact = request.form.get('emergency_contact', '')
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -1285,7 +3459,6 @@ def update_profile():
     """, (phone, address, emergency_contact, emp_id))
     
     conn.commit()
-    conn.close()
     
     flash('Profile updated successfully!', 'success')
     return redirect(url_for('profile'))
@@ -1305,7 +3478,7 @@ def documents():
     user_id = session['user_id']
     role = session['role']
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
     if role == 'admin' and request.path == '/documents': # Admin viewing their own or all? Let's say own for generic route
@@ -1313,7 +3486,11 @@ def documents():
          pass
          
     # Get user's documents
-    cursor.execute("SELECT * FROM documents WHERE user_id = %s ORDER BY uploaded_at DESC", (user_id,))
+    cursor.execute("""
+        SELECT d.*, b.has_thumbnail FROM documents d
+        LEFT JOIN document_blobs b ON b.hash = d.content_hash
+        WHERE d.user_id = %s ORDER BY d.uploaded_at DESC
+    """, (user_id,))
     my_docs = cursor.fetchall()
     
     # If admin, get list of users for upload dropdown
@@ -1322,8 +3499,6 @@ def documents():
         cursor.execute("SELECT id, name, role FROM users ORDER BY name")
         all_users = cursor.fetchall()
         
-    conn.close()
-    
     return render_template('documents.html', documents=my_docs, is_admin=(role=='admin'), all_users=all_users)
 
 @app.route('/admin/documents')
@@ -1331,23 +3506,39 @@ def admin_documents():
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
         
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
-    cursor.execute("""
-        SELECT d.*, u.name as user_name, u.role as user_role 
+    # Search titles, file names and the extracted text of the documents. Each side is its
+    # own FULLTEXT lookup and the UNION of the matching ids is joined in, so both indexes
+    # are used instead of scanning every document for an ORed predicate.
+    q = request.args.get('q', '').strip()
+    hits, params = "", ()
+    if q:
+        hits = """
+        JOIN (
+            SELECT id AS document_id FROM documents
+            WHERE MATCH(title, original_name) AGAINST (%s IN NATURAL LANGUAGE MODE)
+            UNION
+            SELECT td.id FROM document_texts t
+            JOIN documents td ON td.content_hash = t.hash
+            WHERE MATCH(t.content) AGAINST (%s IN NATURAL LANGUAGE MODE)
+        ) hits ON hits.document_id = d.id"""
+        params = (q, q)
+    
+    page = keyset_page(cursor, """
+        SELECT d.*, u.name as user_name, u.role as user_role, b.has_thumbnail
         FROM documents d 
         JOIN users u ON d.user_id = u.id 
-        ORDER BY d.uploaded_at DESC
-    """)
-    all_docs = cursor.fetchall()
+        LEFT JOIN document_blobs b ON b.hash = d.content_hash""" + hits + """
+        WHERE 1 = 1
+    """, params, 'd.uploaded_at', 'd.id')
     
     cursor.execute("SELECT id, name, role FROM users ORDER BY name")
     all_users = cursor.fetchall()
     
-    conn.close()
-    
-    return render_template('documents.html', documents=all_docs, is_admin=True, all_users=all_users)
+    return render_template('documents.html', documents=page['rows'], page=page, is_admin=True, all_users=all_users,
+                           search=q)
 
 @app.route('/documents/upload', methods=['POST'])
 def upload_document():
@@ -1372,55 +3563,128 @@ def upload_document():
         if session['role'] == 'admin' and request.form.get('user_id'):
             user_id = request.form['user_id']
             
-        filename = secure_filename(file.filename)
-        # Add timestamp to filename to avoid duplicates
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S_')
-        filename = timestamp + filename
-        
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        original_name = secure_filename(file.filename) or 'document'
         
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO documents (user_id, title, type, file_path) 
-            VALUES (%s, %s, %s, %s)
-        """, (user_id, title, doc_type, filename))
-        conn.commit()
-        conn.close()
+        try:
+            content_hash, size = store_blob(cursor, file.stream)
+            cursor.execute("""
+                INSERT INTO documents (user_id, title, type, file_path, content_hash, original_name, content_type, size_bytes) 
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, (user_id, title, doc_type, blob_relpath(content_hash), content_hash, original_name, file.mimetype, size))
+            conn.commit()
+            queue_document_preview(cursor, content_hash, file.mimetype)
+        except (OSError, mysql.connector.Error) as e:
+            conn.rollback()
+            print(f"Document upload error: {e}")
+            flash('Upload failed, please try again.', 'danger')
+            return redirect(request.referrer)
         
-        log_audit('Upload Document', f"Uploaded document {filename} for user {user_id}")
+        log_audit('Upload Document', f"Uploaded document {original_name} for user {user_id}")
         
         flash('Document uploaded successfully!', 'success')
         
     return redirect(request.referrer)
 
+@app.route('/documents/<int:doc_id>/download')
+def download_document(doc_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    meta = get_document_meta(doc_id)
+    if not meta or not can_view_document(meta):
+        abort(404)
+    
+    path = safe_join(app.config['UPLOAD_FOLDER'], meta['file_path'])
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    
+    download_name = meta['original_name'] or os.path.basename(meta['file_path'])
+    as_attachment = request.args.get('download') == '1'
+    # Blob contents never change, so the hash is a strong validator; legacy files fall
+    # back to an mtime/size based ETag.
+    etag = meta['content_hash'] or True
+    
+    sendfile = app.config['DOCUMENT_SENDFILE']
+    if sendfile:
+        # Hand the transfer off to the front-end server, which also answers Range requests
+        response = Response(mimetype=meta['content_type'] or mimetypes.guess_type(download_name)[0]
+                            or 'application/octet-stream')
+        if sendfile == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = app.config['DOCUMENT_ACCEL_PREFIX'] + quote(meta['file_path'])
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+        response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline',
+                             filename=download_name)
+        stat = os.stat(path)
+        response.set_etag(meta['content_hash'] or f"{stat.st_mtime}-{stat.st_size}")
+        response.last_modified = stat.st_mtime
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            response.headers.pop('X-Accel-Redirect', None)
+            response.headers.pop('X-Sendfile', None)
+    else:
+        response = send_file(os.path.abspath(path), mimetype=meta['content_type'], as_attachment=as_attachment,
+                             download_name=download_name, conditional=True, etag=etag)
+    
+    # Revalidate on every use (a cheap 304) and keep shared caches out of it
+    response.cache_control.private = True
+    response.cache_control.public = None
+    return response
+
+@app.route('/documents/<int:doc_id>/thumbnail')
+def document_thumbnail(doc_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    meta = get_document_meta(doc_id)
+    if not meta or not meta['content_hash'] or not can_view_document(meta):
+        abort(404)
+    path = thumbnail_path(meta['content_hash'])
+    if not os.path.isfile(path):
+        abort(404)
+    
+    response = send_file(os.path.abspath(path), mimetype='image/jpeg', conditional=True,
+                         etag=f"{meta['content_hash']}-thumb")
+    response.cache_control.private = True
+    return response
+
 @app.route('/documents/delete/<int:doc_id>')
 def delete_document(doc_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
         
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
-    cursor.execute("SELECT * FROM documents WHERE id = %s", (doc_id,))
+    # Lock the row so two concurrent deletes can't both release its blob
+    cursor.execute("SELECT * FROM documents WHERE id = %s FOR UPDATE", (doc_id,))
     doc = cursor.fetchone()
     
     if doc:
         # Check permission: Admin can delete any, User can delete own
         if session['role'] == 'admin' or doc['user_id'] == session['user_id']:
-            try:
-                os.remove(os.path.join(app.config['UPLOAD_FOLDER'], doc['file_path']))
-            except:
-                pass # File might be missing
-            
             cursor.execute("DELETE FROM documents WHERE id = %s", (doc_id,))
+            deleted = cursor.rowcount == 1
+            if deleted and doc['content_hash']:
+                # Shared blob: drop this document's reference, GC removes the file once unused
+                release_blob(cursor, doc['content_hash'])
             conn.commit()
-            log_audit('Delete Document', f"Deleted document {doc_id} ({doc['file_path']})")
+            invalidate_document_meta(doc_id)
+            
+            if deleted and not doc['content_hash']:
+                try:
+                    os.remove(os.path.join(app.config['UPLOAD_FOLDER'], doc['file_path']))
+                except OSError:
+                    pass # File might be missing
+            if deleted:
+                log_audit('Delete Document', f"Deleted document {doc_id} ({doc['file_path']})")
             flash('Document deleted successfully!', 'success')
         else:
+            conn.rollback()
             flash('Permission denied!', 'danger')
             
-    conn.close()
     return redirect(request.referrer)
 
 # ========== PERFORMANCE MANAGEMENT ==========
@@ -1431,25 +3695,22 @@ def performance_reviews():
     if 'user_id' not in session or session['role'] not in ['admin', 'hr']:
         return redirect(url_for('login'))
         
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
-    cursor.execute("""
+    page = keyset_page(cursor, """
         SELECT pr.*, e.name as employee_name, e.department_id, d.name as department_name, u.name as reviewer_name
         FROM performance_reviews pr
         JOIN employees e ON pr.employee_id = e.id
         LEFT JOIN departments d ON e.department_id = d.id
         JOIN users u ON pr.reviewer_id = u.id
-        ORDER BY pr.review_date DESC
-    """)
-    reviews = cursor.fetchall()
+        WHERE 1 = 1
+    """, (), 'pr.review_date', 'pr.id')
     
     cursor.execute("SELECT id, name FROM employees WHERE role = 'employee' ORDER BY name")
     employees = cursor.fetchall()
     
-    conn.close()
-    
-    return render_template('performance.html', reviews=reviews, employees=employees, is_admin=True)
+    return render_template('performance.html', reviews=page['rows'], page=page, employees=employees, is_admin=True)
 
 @app.route('/employee/performance')
 def my_performance():
@@ -1458,7 +3719,7 @@ def my_performance():
         
     emp_id = session.get('emp_id')
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
     cursor.execute("""
@@ -1470,8 +3731,6 @@ def my_performance():
     """, (emp_id,))
     reviews = cursor.fetchall()
     
-    conn.close()
-    
     return render_template('performance.html', reviews=reviews, is_admin=False)
 
 @app.route('/performance/add', methods=['POST'])
@@ -1486,7 +3745,7 @@ def add_performance_review():
     promotion = 1 if 'promotion_suggested' in request.form else 0
     reviewer_id = session['user_id']
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -1495,7 +3754,6 @@ def add_performance_review():
     """, (employee_id, reviewer_id, review_date, rating, comments, promotion))
     
     conn.commit()
-    conn.close()
     
     log_audit('Add Performance Review', f"Added review for employee {employee_id}")
     
@@ -1511,18 +3769,160 @@ def notifications():
         
     user_id = session['user_id']
     
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
-    cursor.execute("SELECT * FROM notifications WHERE user_id = %s ORDER BY created_at DESC", (user_id,))
-    notifs = cursor.fetchall()
+    page = keyset_page(cursor, "SELECT * FROM notifications WHERE user_id = %s", (user_id,), 'created_at', 'id')
     
     # Mark all as read
     cursor.execute("UPDATE notifications SET is_read = 1 WHERE user_id = %s", (user_id,))
     conn.commit()
-    conn.close()
+    reset_notification_count(user_id)
+    
+    return render_template('notifications.html', notifications=page['rows'], page=page)
+
+# ========== GLOBAL SEARCH ==========
+
+# Admin search over document titles and contents, performance review comments and audit
+# log entries, backed by the FULLTEXT indexes of migrations 010 and 011. Each source
+# returns (kind, id, title, snippet, person, occurred_at, score); hits of a document on
+# both its title and its text are merged and their scores added up.
+SEARCH_SOURCES = OrderedDict([
+    ('document', ["""
+        SELECT 'document' AS kind, d.id, d.title, d.original_name AS snippet, u.name AS person,
+               d.uploaded_at AS occurred_at, MATCH(d.title, d.original_name) AGAINST (%(q)s) AS score
+        FROM documents d
+        JOIN users u ON d.user_id = u.id
+        WHERE MATCH(d.title, d.original_name) AGAINST (%(q)s)
+    """, """
+        SELECT 'document' AS kind, d.id, d.title,
+               SUBSTRING(t.content, GREATEST(LOCATE(%(term)s, t.content) - 80, 1), 240) AS snippet,
+               u.name AS person, d.uploaded_at AS occurred_at, MATCH(t.content) AGAINST (%(q)s) AS score
+        FROM document_texts t
+        JOIN documents d ON d.content_hash = t.hash
+        JOIN users u ON d.user_id = u.id
+        WHERE MATCH(t.content) AGAINST (%(q)s)
+    """]),
+    ('review', ["""
+        SELECT 'review' AS kind, pr.id, CONCAT('Review of ', e.name) AS title,
+               SUBSTRING(pr.comments, GREATEST(LOCATE(%(term)s, pr.comments) - 80, 1), 240) AS snippet,
+               u.name AS person, pr.review_date AS occurred_at, MATCH(pr.comments) AGAINST (%(q)s) AS score
+        FROM performance_reviews pr
+        JOIN employees e ON pr.employee_id = e.id
+        JOIN users u ON pr.reviewer_id = u.id
+        WHERE MATCH(pr.comments) AGAINST (%(q)s)
+    """]),
+    ('audit', ["""
+        SELECT 'audit' AS kind, a.id, a.action AS title,
+               SUBSTRING(a.details, GREATEST(LOCATE(%(term)s, a.details) - 80, 1), 240) AS snippet,
+               u.name AS person, a.timestamp AS occurred_at, MATCH(a.action, a.details) AGAINST (%(q)s) AS score
+        FROM audit_logs a
+        LEFT JOIN users u ON a.user_id = u.id
+        WHERE MATCH(a.action, a.details) AGAINST (%(q)s)
+    """]),
+])
+
+SEARCH_KIND_LABELS = {'document': 'Document', 'review': 'Performance Review', 'audit': 'Audit Log'}
+
+# Ranked hits for q, optionally limited to some kinds. Relevance does not give a stable
+# seek key, so pages are offset based, capped at SEARCH_MAX_RESULTS.
+def global_search(cursor, q, kinds=None, page=1, page_size=None):
+    page_size = page_size or app.config['PAGE_SIZE']
+    kinds = [kind for kind in (kinds or SEARCH_SOURCES) if kind in SEARCH_SOURCES]
+    offset = (page - 1) * page_size
+    if not kinds or offset >= app.config['SEARCH_MAX_RESULTS']:
+        return [], False
+    
+    # No source can contribute more than the rows up to the end of this page, so each
+    # branch stops after that many of its best matches instead of returning every hit
+    branch_limit = offset + page_size + 1
+    branches = [f"({sql.rstrip()} ORDER BY score DESC LIMIT %(branch_limit)s)"
+                for kind in kinds for sql in SEARCH_SOURCES[kind]]
+    # The snippet comes from the best-scoring branch of a merged hit
+    cursor.execute(f"""
+        SELECT kind, id, MAX(title) AS title,
+               SUBSTRING_INDEX(GROUP_CONCAT(snippet ORDER BY score DESC SEPARATOR '\\0'), '\\0', 1) AS snippet,
+               MAX(person) AS person, MAX(occurred_at) AS occurred_at, SUM(score) AS score
+        FROM ({' UNION ALL '.join(branches)}) hits
+        GROUP BY kind, id
+        ORDER BY score DESC, occurred_at DESC
+        LIMIT %(limit)s OFFSET %(offset)s
+    """, {'q': q, 'term': q.split()[0], 'limit': page_size + 1, 'offset': offset, 'branch_limit': branch_limit})
+    rows = cursor.fetchall()
+    has_next = len(rows) > page_size and offset + page_size < app.config['SEARCH_MAX_RESULTS']
+    return rows[:page_size], has_next
+
+def search_hit_url(hit):
+    if hit['kind'] == 'document':
+        return url_for('download_document', doc_id=hit['id'])
+    if hit['kind'] == 'review':
+        return url_for('performance_reviews')
+    return url_for('audit_logs')
+
+def search_request():
+    q = ' '.join(request.args.get('q', '').split())
+    kinds = request.args.getlist('type') or None
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    return q, kinds, page
+
+# Admin - Search documents, reviews and audit logs
+@app.route('/admin/search')
+def admin_search():
+    if 'user_id' not in session or session['role'] != 'admin':
+        return redirect(url_for('login'))
     
-    return render_template('notifications.html', notifications=notifs)
+    q, kinds, page_number = search_request()
+    hits, has_next = [], False
+    if q:
+        cursor = get_db().cursor(dictionary=True)
+        hits, has_next = global_search(cursor, q, kinds, page_number)
+        for hit in hits:
+            hit['url'] = search_hit_url(hit)
+    
+    args = request.args.to_dict(flat=False)
+    page = {
+        'rows': hits,
+        'next_url': url_for('admin_search', **dict(args, page=page_number + 1)) if has_next else None,
+        'prev_url': url_for('admin_search', **dict(args, page=page_number - 1)) if page_number > 1 else None,
+        'first_url': url_for('admin_search', **dict(args, page=1)) if page_number > 2 else None
+    }
+    return render_template('admin_search.html', hits=hits, page=page, q=q, kinds=kinds or [],
+                           kind_labels=SEARCH_KIND_LABELS)
+
+# Search API - ranked JSON hits for admins
+@app.route('/api/admin/search')
+def admin_search_api():
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    q, kinds, page_number = search_request()
+    if not q:
+        return jsonify({'error': 'Missing search query'}), 400
+    
+    cursor = get_db().cursor(dictionary=True)
+    hits, has_next = global_search(cursor, q, kinds, page_number)
+    results = []
+    for hit in hits:
+        results.append({
+            'kind': hit['kind'],
+            'id': hit['id'],
+            'title': hit['title'],
+            'snippet': hit['snippet'],
+            'person': hit['person'],
+            'occurred_at': hit['occurred_at'].isoformat() if hit['occurred_at'] else None,
+            'score': float(hit['score']),
+            'url': search_hit_url(hit)
+        })
+    
+    return jsonify({
+        'results': results,
+        'count': len(results),
+        'page': page_number,
+        'next': url_for('admin_search_api', **dict(request.args.to_dict(flat=False), page=page_number + 1)) if has_next else None
+    })
 
 # ========== AUDIT LOGS ==========
 
@@ -1531,82 +3931,577 @@ def audit_logs():
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
         
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
     
-    cursor.execute("""
-        SELECT a.*, u.name as user_name, u.role as user_role
-        FROM audit_logs a
-        LEFT JOIN users u ON a.user_id = u.id
-        ORDER BY a.timestamp DESC
-        LIMIT 100
-    """)
-    logs = cursor.fetchall()
+    try:
+        filters = audit_log_filters(request.args)
+    except ValueError:
+        flash('Invalid audit log filter!', 'danger')
+        return redirect(url_for('audit_logs'))
     
-    conn.close()
+    rows, has_more = query_audit_logs(cursor, **filters)
+    page = audit_page_links('audit_logs', rows, has_more, filters)
     
-    return render_template('audit_logs.html', logs=logs)
+    cursor.execute("SELECT id, name FROM users ORDER BY name")
+    users = cursor.fetchall()
+    
+    return render_template('audit_logs.html', logs=rows, page=page, users=users, filters=request.args)
+
+# Audit log API - filtered JSON across the hot table and the archives
+@app.route('/api/audit-logs')
+def audit_logs_api():
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    try:
+        filters = audit_log_filters(request.args)
+        limit = min(max(int(request.args.get('per_page', app.config['PAGE_SIZE'])), 1), app.config['MAX_PAGE_SIZE'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    cursor = get_db().cursor(dictionary=True)
+    rows, has_more = query_audit_logs(cursor, limit=limit, **filters)
+    page = audit_page_links('audit_logs_api', rows, has_more, filters)
+    for row in rows:
+        row['timestamp'] = row['timestamp'].isoformat()
+    
+    return jsonify({
+        'logs': rows,
+        'count': len(rows),
+        'next': page['next_url'],
+        'prev': page['prev_url']
+    })
+
+# Admin - Database pool metrics
+@app.route('/admin/db-pool')
+def db_pool_metrics():
+    if 'user_id' not in session or session['role'] != 'admin':
+        return redirect(url_for('login'))
+    return jsonify(db_pool.snapshot())
 
 # ========== REPORTS ==========
 
+def report_departments():
+    cursor = get_db().cursor(dictionary=True)
+    cursor.execute("SELECT id, name FROM departments ORDER BY name")
+    return cursor.fetchall()
+
 @app.route('/admin/reports')
 def admin_reports():
     if 'user_id' not in session or session['role'] != 'admin':
         return redirect(url_for('login'))
-    return render_template('reports.html')
+    return render_template('reports.html', departments=report_departments())
 
 @app.route('/hr/reports')
 def hr_reports():
     if 'user_id' not in session or session['role'] != 'hr':
         return redirect(url_for('login'))
-    return render_template('reports.html')
+    return render_template('reports.html', departments=report_departments())
+
+# Report definitions: header, base query, and the columns the date/department filters apply to
+REPORTS = {
+    'employees': {
+        'header': ['Name', 'Email', 'Position', 'Department', 'Salary', 'Joining Date'],
+        'sql': """SELECT e.name, e.email, e.position, d.name as department, e.salary, e.joining_date
+                  FROM employees e LEFT JOIN departments d ON e.department_id = d.id""",
+        'date_column': 'e.joining_date',
+        'order_by': 'e.id',
+        'tables': ['employees', 'departments']
+    },
+    'attendance': {
+        'header': ['Name', 'Date', 'Check In', 'Check Out', 'Status'],
+        'sql': """SELECT e.name, a.date, a.check_in, a.check_out, a.status
+                  FROM attendance a JOIN employees e ON a.employee_id = e.id""",
+        'date_column': 'a.date',
+        'order_by': 'a.date DESC',
+        'tables': ['attendance', 'employees']
+    },
+    'payroll': {
+        'header': ['Name', 'Month', 'Basic Salary', 'Net Salary', 'Status'],
+        'sql': """SELECT e.name, p.month_year, p.basic_salary, p.net_salary, p.status
+                  FROM payroll p JOIN employees e ON p.employee_id = e.id""",
+        'date_column': 'p.month_year',
+        'order_by': 'p.month_year DESC',
+        'tables': ['payroll', 'employees']
+    }
+}
+
+# Optional report filters from query args: inclusive date range and department
+def report_filters(args):
+    filters = {}
+    for key in ('date_from', 'date_to'):
+        try:
+            filters[key] = date.fromisoformat(args.get(key, '')).isoformat()
+        except ValueError:
+            pass
+    if args.get('dept_id', '').isdigit():
+        filters['dept_id'] = int(args['dept_id'])
+    return filters
+
+def report_query(report_type, filters):
+    report = REPORTS[report_type]
+    conditions, params = [], []
+    if 'date_from' in filters:
+        conditions.append(f"{report['date_column']} >= %s")
+        params.append(filters['date_from'])
+    if 'date_to' in filters:
+        conditions.append(f"{report['date_column']} < %s")
+        params.append(date.fromisoformat(filters['date_to']) + timedelta(days=1))
+    if 'dept_id' in filters:
+        conditions.append("e.department_id = %s")
+        params.append(filters['dept_id'])
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    return f"{report['sql']}{where} ORDER BY {report['order_by']}", params
+
+# Stream report rows from an unbuffered cursor, EXPORT_FETCH_SIZE rows per round trip,
+# so memory use stays flat however large the result is
+def report_rows(conn, report_type, filters, fetch_size=None):
+    fetch_size = fetch_size or app.config['EXPORT_FETCH_SIZE']
+    sql, params = report_query(report_type, filters)
+    cursor = conn.cursor(buffered=False)
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        try:
+            cursor.close()
+        except mysql.connector.Error:
+            # Closed early with rows still unread; the caller must not reuse the connection
+            pass
+
+# Stream a report over a connection of its own. If the client goes away mid-download
+# the unbuffered result is left unread, so that connection is discarded rather than
+# handed back to the pool.
+def streamed_report_rows(report_type, filters):
+    conn = db_pool.acquire()
+    completed = False
+    try:
+        yield from report_rows(conn, report_type, filters)
+        completed = True
+    finally:
+        if completed:
+            db_pool.release(conn)
+        else:
+            db_pool.discard(conn)
+
+# Turn batches of rows into encoded CSV chunks (one chunk per batch)
+def csv_chunks(header, row_batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for rows in row_batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
 @app.route('/download/report/<type>')
 def download_report(type):
     if 'user_id' not in session or session['role'] not in ['admin', 'hr']:
         return redirect(url_for('login'))
     
-    import csv
-    import io
-    from flask import make_response
-
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
+    if type not in REPORTS:
+        flash('Unknown report type!', 'danger')
+        return redirect(request.referrer or url_for('home'))
     
+    filters = report_filters(request.args)
     filename = f"{type}_report_{date.today()}.csv"
     
-    if type == 'employees':
-        cursor.execute("SELECT e.name, e.email, e.position, d.name as department, e.salary, e.joining_date FROM employees e LEFT JOIN departments d ON e.department_id = d.id")
-        data = cursor.fetchall()
-        writer.writerow(['Name', 'Email', 'Position', 'Department', 'Salary', 'Joining Date'])
-        for row in data:
-            writer.writerow([row['name'], row['email'], row['position'], row['department'], row['salary'], row['joining_date']])
-            
-    elif type == 'attendance':
-        cursor.execute("SELECT e.name, a.date, a.check_in, a.check_out, a.status FROM attendance a JOIN employees e ON a.employee_id = e.id ORDER BY a.date DESC LIMIT 1000")
-        data = cursor.fetchall()
-        writer.writerow(['Name', 'Date', 'Check In', 'Check Out', 'Status'])
-        for row in data:
-            writer.writerow([row['name'], row['date'], row['check_in'], row['check_out'], row['status']])
-            
-    elif type == 'payroll':
-        cursor.execute("SELECT e.name, p.month_year, p.basic_salary, p.net_salary, p.status FROM payroll p JOIN employees e ON p.employee_id = e.id ORDER BY p.month_year DESC LIMIT 1000")
-        data = cursor.fetchall()
-        writer.writerow(['Name', 'Month', 'Basic Salary', 'Net Salary', 'Status'])
-        for row in data:
-            writer.writerow([row['name'], row['month_year'], row['basic_salary'], row['net_salary'], row['status']])
-            
-    conn.close()
+    body = csv_chunks(REPORTS[type]['header'], streamed_report_rows(type, filters))
+    if request.args.get('gzip'):
+        body = gzip_chunks(body)
+        filename += '.gz'
     
-    output.seek(0)
-    response = make_response(output.getvalue())
+    response = Response(stream_with_context(body), mimetype='application/gzip' if request.args.get('gzip') else 'text/csv')
     response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-    response.headers["Content-type"] = "text/csv"
     return response
 
+# ========== REPORT JOBS ==========
+
+# Large reports are built by a process pool into REPORT_FOLDER. A job id is a hash of
+# (type, filters, data versions of the tables read), so an unchanged report is built
+# once and then served from disk. Job state lives next to the file in <job_id>.json,
+# which lets any gunicorn worker answer status requests.
+
+_report_executor = None
+_report_executor_pid = None
+
+def get_report_executor():
+    global _report_executor, _report_executor_pid
+    if _report_executor is None or _report_executor_pid != os.getpid():
+        _report_executor = ProcessPoolExecutor(max_workers=app.config['REPORT_WORKERS'],
+                                               mp_context=multiprocessing.get_context('spawn'))
+        _report_executor_pid = os.getpid()
+    return _report_executor
+
+def write_job_state(folder, job_id, state):
+    path = os.path.join(folder, f"{job_id}.json")
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+def read_job_state(folder, job_id):
+    try:
+        with open(os.path.join(folder, f"{job_id}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Only one build per job id: the submitter that creates <job_id>.lock (O_EXCL, atomic
+# across processes sharing REPORT_FOLDER) runs the job, and the worker removes the lock
+# when it finishes. A lock whose job stopped updating its state is taken over.
+def claim_report_job(folder, job_id):
+    lock = os.path.join(folder, f"{job_id}.lock")
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        pass
+    try:
+        last_update = os.path.getmtime(lock)
+        state_path = os.path.join(folder, f"{job_id}.json")
+        if os.path.exists(state_path):
+            last_update = max(last_update, os.path.getmtime(state_path))
+        if time.time() - last_update < app.config['REPORT_JOB_STALE_AFTER']:
+            return False
+        # Rename first so that only one of several concurrent takers removes it
+        stale = f"{lock}.{os.getpid()}.{threading.get_ident()}"
+        os.rename(lock, stale)
+        os.remove(stale)
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except (FileNotFoundError, FileExistsError):
+        return False
+    return True
+
+def release_report_job(folder, job_id):
+    try:
+        os.remove(os.path.join(folder, f"{job_id}.lock"))
+    except FileNotFoundError:
+        pass
+
+# Runs in a worker process: opens its own connection and streams the report to disk
+def build_report_file(folder, job_id, report_type, filters, connect_args, fetch_size):
+    try:
+        run_report_build(folder, job_id, report_type, filters, connect_args, fetch_size)
+    finally:
+        release_report_job(folder, job_id)
+
+def run_report_build(folder, job_id, report_type, filters, connect_args, fetch_size):
+    state = {'job_id': job_id, 'type': report_type, 'filters': filters, 'state': 'running', 'rows': 0}
+    write_job_state(folder, job_id, state)
+    path = os.path.join(folder, f"{job_id}.csv")
+    try:
+        conn = mysql.connector.connect(**connect_args)
+        try:
+            def counted(batches):
+                for rows in batches:
+                    state['rows'] += len(rows)
+                    write_job_state(folder, job_id, state)
+                    yield rows
+            with open(path + '.tmp', 'wb') as f:
+                for chunk in csv_chunks(REPORTS[report_type]['header'], counted(report_rows(conn, report_type, filters, fetch_size))):
+                    f.write(chunk)
+            os.replace(path + '.tmp', path)
+        finally:
+            conn.close()
+        state['state'] = 'done'
+    except Exception as e:
+        state.update(state='failed', error=str(e))
+    state['finished_at'] = datetime.now().isoformat(timespec='seconds')
+    write_job_state(folder, job_id, state)
+
+def prune_report_cache(folder):
+    cutoff = time.time() - app.config['REPORT_CACHE_MAX_AGE']
+    for entry in os.scandir(folder):
+        # Locks belong to running jobs; stale ones are taken over by claim_report_job()
+        if entry.is_file() and not entry.name.endswith('.lock') and entry.stat().st_mtime < cutoff:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+def submit_report_job(report_type, filters):
+    folder = app.config['REPORT_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+
+    versions = get_data_versions(get_db().cursor(), REPORTS[report_type]['tables'])
+    key = json.dumps([report_type, sorted(filters.items()), sorted(versions.items())], default=str)
+    job_id = hashlib.sha1(key.encode()).hexdigest()[:24]
+
+    state = read_job_state(folder, job_id)
+    if state and state['state'] == 'done' and os.path.exists(os.path.join(folder, f"{job_id}.csv")):
+        return job_id, state
+    # A job whose state file stopped updating belonged to a worker that died; rebuild it
+    if state and state['state'] in ('queued', 'running'):
+        state_age = time.time() - os.path.getmtime(os.path.join(folder, f"{job_id}.json"))
+        if state_age < app.config['REPORT_JOB_STALE_AFTER']:
+            return job_id, state
+
+    if not claim_report_job(folder, job_id):
+        # Another request or worker is already building it
+        state = read_job_state(folder, job_id) or {'job_id': job_id, 'type': report_type, 'filters': filters,
+                                                   'state': 'queued', 'rows': 0}
+        return job_id, state
+
+    prune_report_cache(folder)
+    state = {'job_id': job_id, 'type': report_type, 'filters': filters, 'state': 'queued', 'rows': 0}
+    write_job_state(folder, job_id, state)
+    try:
+        get_report_executor().submit(build_report_file, folder, job_id, report_type, filters,
+                                     db_pool.connect_args, app.config['EXPORT_FETCH_SIZE'])
+    except Exception:
+        release_report_job(folder, job_id)
+        raise
+    return job_id, state
+
+def job_status_payload(job_id, state):
+    payload = dict(state, status_url=url_for('report_job_status', job_id=job_id))
+    if state['state'] == 'done':
+        payload['download_url'] = url_for('download_report_job', job_id=job_id)
+    return payload
+
+# Submit a report job; returns immediately with the job id and its status URL
+@app.route('/reports/jobs/<type>', methods=['POST'])
+def submit_report(type):
+    if 'user_id' not in session or session['role'] not in ['admin', 'hr']:
+        return redirect(url_for('login'))
+    if type not in REPORTS:
+        return jsonify({'error': 'Unknown report type'}), 404
+    
+    job_id, state = submit_report_job(type, report_filters(request.values))
+    return jsonify(job_status_payload(job_id, state)), 202
+
+@app.route('/reports/jobs/<job_id>/status')
+def report_job_status(job_id):
+    if 'user_id' not in session or session['role'] not in ['admin', 'hr']:
+        return redirect(url_for('login'))
+    
+    state = read_job_state(app.config['REPORT_FOLDER'], secure_filename(job_id))
+    if state is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job_status_payload(job_id, state))
+
+@app.route('/reports/jobs/<job_id>/download')
+def download_report_job(job_id):
+    if 'user_id' not in session or session['role'] not in ['admin', 'hr']:
+        return redirect(url_for('login'))
+    
+    job_id = secure_filename(job_id)
+    state = read_job_state(app.config['REPORT_FOLDER'], job_id)
+    if state is None or state['state'] != 'done':
+        flash('Report is not ready yet.', 'warning')
+        return redirect(request.referrer or url_for('home'))
+    
+    return send_from_directory(app.config['REPORT_FOLDER'], f"{job_id}.csv", as_attachment=True,
+                               download_name=f"{state['type']}_report_{state.get('finished_at', '')[:10]}.csv",
+                               mimetype='text/csv')
+
+# ========== DATABASE MIGRATIONS ==========
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# Migration files are named NNN_description.sql and applied in version order
+def list_migrations():
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        if filename.endswith('.sql') and filename.split('_', 1)[0].isdigit():
+            migrations.append((int(filename.split('_', 1)[0]), filename))
+    return migrations
+
+def split_sql_statements(script):
+    lines = [line for line in script.splitlines() if not line.strip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+def apply_migrations(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version int(11) NOT NULL,
+            name varchar(255) NOT NULL,
+            applied_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (version)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+    cursor.execute("SELECT version FROM schema_migrations")
+    applied_versions = {row[0] for row in cursor.fetchall()}
+
+    applied = []
+    for version, filename in list_migrations():
+        if version in applied_versions:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, filename)) as f:
+            statements = split_sql_statements(f.read())
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, filename))
+        conn.commit()
+        applied.append(filename)
+    return applied
+
+# Queries run on hot paths, with sample parameters and the table that must be read through an index
+HOT_QUERIES = [
+    ('mark_attendance: today record', 'attendance',
+     "SELECT * FROM attendance WHERE employee_id = %s AND date = %s", (1, date.today())),
+    ('dashboards: today attendance', 'attendance',
+     "SELECT COUNT(*) FROM attendance WHERE date = CURDATE()", ()),
+    ('admin_attendance: day join', 'a',
+     """SELECT e.name, a.status FROM employees e
+        LEFT JOIN attendance a ON e.id = a.employee_id AND a.date = %s""", (date.today(),)),
+    ('dashboards: pending leaves', 'leave_requests',
+     "SELECT COUNT(*) FROM leave_requests WHERE status = 'pending'", ()),
+    ('my_leaves: history', 'leave_requests',
+     "SELECT * FROM leave_requests WHERE employee_id = %s ORDER BY start_date DESC", (1,)),
+    ('admin_payroll: month listing', 'p',
+     """SELECT p.* FROM payroll p JOIN employees e ON p.employee_id = e.id
+        WHERE p.month_year >= %s AND p.month_year < %s""", month_bounds()),
+    ('mark_attendance: monthly summary', 'attendance',
+     "SELECT COUNT(*) FROM attendance WHERE employee_id = %s AND date >= %s AND date < %s", (1,) + month_bounds()),
+    ('audit_logs: latest entries', 'a',
+     "SELECT a.* FROM audit_logs a ORDER BY a.timestamp DESC LIMIT 100", ()),
+    ('notifications: unread count', 'notifications',
+     "SELECT COUNT(*) FROM notifications WHERE user_id = %s AND is_read = 0", (1,)),
+    ('employee_search: name prefix', 'e',
+     EMPLOYEE_SEARCH_SQL + " AND (e.name LIKE %s OR e.email LIKE %s) AND e.role = %s ORDER BY e.name, e.id LIMIT 25",
+     ('a%', 'a%', 'employee')),
+    ('employee_search: department', 'e',
+     EMPLOYEE_SEARCH_SQL + " AND e.department_id = %s AND e.role = %s ORDER BY e.name, e.id LIMIT 25", (1, 'employee')),
+]
+
+# EXPLAIN each hot query and report the ones that scan their table instead of using an index
+def check_query_indexes(conn):
+    cursor = conn.cursor(dictionary=True)
+    results = []
+    for name, table, sql, params in HOT_QUERIES:
+        cursor.execute("EXPLAIN " + sql, params)
+        plan = [row for row in cursor.fetchall() if row['table'] == table]
+        uses_index = bool(plan) and all(row['type'] != 'ALL' and (row['key'] or row['type'] == 'index') for row in plan)
+        results.append((name, uses_index, plan[0]['key'] if plan else None))
+    return results
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Apply pending schema migrations."""
+    applied = apply_migrations(get_db())
+    for filename in applied:
+        click.echo(f"Applied {filename}")
+    click.echo(f"{len(applied)} migration(s) applied.")
+
+@app.cli.command('db-check-indexes')
+def db_check_indexes_command():
+    """EXPLAIN the hot queries and fail if any of them scans a whole table."""
+    failures = 0
+    for name, uses_index, key in check_query_indexes(get_db()):
+        click.echo(f"{'ok  ' if uses_index else 'SCAN'} {name} ({key or 'no index'})")
+        failures += 0 if uses_index else 1
+    if failures:
+        raise SystemExit(1)
+
+@app.cli.command('import-attendance')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dept-id', type=int, default=None, help='Only accept employees of this department.')
+@click.option('--chunk-size', type=int, default=None, help='Rows per multi-row upsert.')
+def import_attendance_command(path, dept_id, chunk_size):
+    """Bulk import attendance from a CSV or JSONL file."""
+    with open(path, 'rb') as f:
+        report = import_attendance(get_db(), f, import_format(path), dept_id is not None, dept_id, chunk_size)
+    invalidate_dashboard_stats(dept_id)
+    for error in report['errors']:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    click.echo(f"Imported {report['imported']} rows, skipped {len(report['errors'])}, "
+               f"{report['seconds']}s ({report['rows_per_second']} rows/s)")
+
+@app.cli.command('onboard-employees')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', type=int, default=None, help='Accounts per multi-row insert.')
+def onboard_employees_command(path, chunk_size):
+    """Create employee accounts in bulk from a CSV or JSONL file."""
+    with open(path, 'rb') as f:
+        report = onboard_employees(get_db(), f, import_format(path), chunk_size)
+    for error in report['errors']:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    click.echo(f"Created {report['created']} accounts, skipped {len(report['errors'])}, "
+               f"{report['seconds']}s ({report['rows_per_second']} rows/s)")
+
+@app.cli.command('accrue-leave')
+@click.option('--year', type=int, default=None, help='Leave year to accrue (defaults to the current year).')
+def accrue_leave_command(year):
+    """Create or refresh every employee's leave balances for a year."""
+    year = year or date.today().year
+    balances = accrue_leave(get_db(), year)
+    click.echo(f"Leave balances for {year}: {balances} rows")
+
+@app.cli.command('gc-documents')
+@click.option('--grace', type=int, default=None, help='Skip files modified in the last N seconds.')
+def gc_documents_command(grace):
+    """Delete document blobs that no document references any more."""
+    result = gc_blobs(get_db(), grace)
+    click.echo(f"Removed {result['blobs_removed']} unreferenced blobs and {result['orphans_removed']} orphaned files, "
+               f"{result['bytes_freed'] / (1024 * 1024):.1f} MB freed")
+
+@app.cli.command('build-previews')
+@click.option('--retry-failed', is_flag=True, help='Also rebuild blobs whose previous attempt failed.')
+def build_previews_command(retry_failed):
+    """Build thumbnails and extracted text for blobs that do not have them yet."""
+    conn = get_db()
+    cursor = conn.cursor(dictionary=True)
+    states = ('pending', 'failed') if retry_failed else ('pending',)
+    cursor.execute(f"""
+        SELECT b.hash, MAX(d.content_type) AS content_type
+        FROM document_blobs b
+        JOIN documents d ON d.content_hash = b.hash
+        WHERE b.preview_state IN ({', '.join(['%s'] * len(states))})
+        GROUP BY b.hash
+    """, states)
+    blobs = cursor.fetchall()
+    conn.rollback()
+    
+    done = 0
+    for blob in blobs:
+        state = build_document_preview(os.path.abspath(blob_path(blob['hash'])), blob['hash'], blob['content_type'],
+                                       db_pool.connect_args, app.config['DOCUMENT_TEXT_MAX_CHARS'],
+                                       app.config['DOCUMENT_THUMBNAIL_SIZE'])
+        done += state == 'done'
+    click.echo(f"Built previews for {done} of {len(blobs)} blobs")
+
+@app.cli.command('archive-audit-logs')
+@click.option('--months', type=int, default=None, help='Months to keep in audit_logs (default AUDIT_RETENTION_MONTHS).')
+def archive_audit_logs_command(months):
+    """Move audit log months older than the retention window into gzipped JSONL archives."""
+    archived = archive_audit_logs(get_db(), months)
+    for entry in archived:
+        click.echo(f"{entry['month']}: archived {entry['rows']} rows, removed {entry['purged']} from audit_logs")
+    if not archived:
+        click.echo("Nothing to archive")
+
+@app.cli.command('run-payroll')
+@click.argument('month')
+def run_payroll_command(month):
+    """Generate (or regenerate) payroll for MONTH, given as YYYY-MM."""
+    try:
+        month_start = datetime.strptime(month, '%Y-%m').date()
+    except ValueError:
+        raise click.BadParameter('expected YYYY-MM', param_hint='MONTH')
+    started = time.monotonic()
+    result = run_payroll(get_db(), month_start)
+    click.echo(f"Payroll {result['month']}: {result['payslips']} payslips ({result['paid']} paid, unchanged), "
+               f"net total {result['total_net']}, {result['working_days']} working days, "
+               f"{time.monotonic() - started:.2f}s")
+
 # ========== RUN APP ==========
 
 if __name__ == '__main__':
@@ -1,4 +1,6 @@
 -- Database: hrms
+-- Base schema. Indexes and later schema changes live in migrations/;
+-- apply them after loading this file with: flask --app app db-upgrade
 CREATE DATABASE IF NOT EXISTS hrms;
 USE hrms;
 
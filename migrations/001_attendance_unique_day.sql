@@ -0,0 +1,10 @@
+-- One attendance row per employee per day.
+-- Remove duplicates left by the old SELECT-then-INSERT check-in (keep the earliest row)
+DELETE a1 FROM attendance a1
+JOIN attendance a2 ON a1.employee_id = a2.employee_id AND a1.date = a2.date AND a1.id > a2.id;
+
+-- (employee_id, date) serves check-in, manual attendance and the per-day joins;
+-- (date) serves the "today" counters that are not scoped to one employee
+ALTER TABLE attendance
+  ADD UNIQUE KEY uq_attendance_employee_date (employee_id, date),
+  ADD KEY idx_attendance_date (date);
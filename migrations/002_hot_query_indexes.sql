@@ -0,0 +1,19 @@
+-- Secondary indexes for the lookups made on every dashboard and listing page
+
+-- Pending queues (admin) and per-employee history / department stats (HR)
+ALTER TABLE leave_requests
+  ADD KEY idx_leave_status_start (status, start_date),
+  ADD KEY idx_leave_employee_status (employee_id, status);
+
+-- Monthly payroll listings
+ALTER TABLE payroll
+  ADD KEY idx_payroll_month (month_year),
+  ADD KEY idx_payroll_employee_month (employee_id, month_year);
+
+-- Audit log listing ordered by time
+ALTER TABLE audit_logs
+  ADD KEY idx_audit_timestamp (timestamp);
+
+-- Unread notification counter
+ALTER TABLE notifications
+  ADD KEY idx_notifications_user_read (user_id, is_read);
@@ -0,0 +1,13 @@
+-- One row per actual salary change, written by the bulk salary update
+CREATE TABLE IF NOT EXISTS salary_history (
+  id int(11) NOT NULL AUTO_INCREMENT,
+  employee_id int(11) NOT NULL,
+  old_salary decimal(10,2) DEFAULT NULL,
+  new_salary decimal(10,2) NOT NULL,
+  changed_by int(11) DEFAULT NULL,
+  changed_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (id),
+  KEY idx_salary_history_employee (employee_id, changed_at),
+  FOREIGN KEY (employee_id) REFERENCES employees (id) ON DELETE CASCADE,
+  FOREIGN KEY (changed_by) REFERENCES users (id) ON DELETE SET NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
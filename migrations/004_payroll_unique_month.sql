@@ -0,0 +1,8 @@
+-- A payroll run must be repeatable: one payslip per employee per month.
+-- Keep the newest row if older data has duplicates.
+DELETE p1 FROM payroll p1
+JOIN payroll p2 ON p1.employee_id = p2.employee_id AND p1.month_year = p2.month_year AND p1.id < p2.id;
+
+ALTER TABLE payroll
+  DROP KEY idx_payroll_employee_month,
+  ADD UNIQUE KEY uq_payroll_employee_month (employee_id, month_year);
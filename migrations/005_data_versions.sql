@@ -0,0 +1,12 @@
+-- Change counters for tables that feed cached reports. Writers bump the counter in the
+-- same transaction as their change; report caches key on the current values.
+CREATE TABLE IF NOT EXISTS data_versions (
+  name varchar(50) NOT NULL,
+  version bigint(20) NOT NULL DEFAULT 0,
+  updated_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (name)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+INSERT INTO data_versions (name, version) VALUES
+('employees', 0), ('departments', 0), ('attendance', 0), ('payroll', 0)
+ON DUPLICATE KEY UPDATE name = name;
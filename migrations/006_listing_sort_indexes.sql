@@ -0,0 +1,18 @@
+-- Indexes matching the (sort key, id) order of the paginated listings.
+-- InnoDB appends the primary key to every secondary index, so id is covered implicitly.
+
+-- Employee / HR manager / salary listings: WHERE role = ? ORDER BY name, id
+ALTER TABLE employees
+  ADD KEY idx_employees_role_name (role, name);
+
+-- Admin documents: ORDER BY uploaded_at DESC, id DESC
+ALTER TABLE documents
+  ADD KEY idx_documents_uploaded (uploaded_at);
+
+-- Performance reviews: ORDER BY review_date DESC, id DESC
+ALTER TABLE performance_reviews
+  ADD KEY idx_reviews_date (review_date);
+
+-- Notifications: WHERE user_id = ? ORDER BY created_at DESC, id DESC
+ALTER TABLE notifications
+  ADD KEY idx_notifications_user_created (user_id, created_at);
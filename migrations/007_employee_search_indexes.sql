@@ -0,0 +1,15 @@
+-- Indexes backing the server-side employee search (/api/employees/search).
+-- Name/email searches are prefix LIKEs, so plain B-tree indexes serve them as range scans.
+
+-- Department directories: WHERE department_id = ? AND role = ? ORDER BY name, id
+ALTER TABLE employees
+  ADD KEY idx_employees_dept_role_name (department_id, role, name);
+
+-- Email prefix search (the name prefix is served by idx_employees_role_name)
+ALTER TABLE employees
+  ADD KEY idx_employees_email (email);
+
+-- Position filter and joining-date range filter
+ALTER TABLE employees
+  ADD KEY idx_employees_position (position),
+  ADD KEY idx_employees_joining_date (joining_date);
@@ -0,0 +1,34 @@
+-- Leave ledger: one balance row per employee, leave type and year, kept up to date as
+-- requests are applied for, approved and rejected (see the LEAVE LEDGER section of app.py).
+-- leave_requests.leave_type stores leave_types.code. Run `flask --app app accrue-leave`
+-- once after applying this to seed the current year's balances from existing requests.
+
+CREATE TABLE IF NOT EXISTS leave_types (
+  id int(11) NOT NULL AUTO_INCREMENT,
+  code varchar(50) NOT NULL,
+  name varchar(100) NOT NULL,
+  annual_days decimal(5,1) DEFAULT NULL,  -- NULL: not balance-tracked (e.g. unpaid leave)
+  carry_forward_max decimal(5,1) NOT NULL DEFAULT 0,  -- unused days that move to the next year
+  PRIMARY KEY (id),
+  UNIQUE KEY uq_leave_types_code (code)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+INSERT INTO leave_types (code, name, annual_days, carry_forward_max) VALUES
+('sick', 'Sick Leave', 10, 0),
+('casual', 'Casual Leave', 12, 0),
+('earned', 'Earned Leave', 20, 10),
+('unpaid', 'Unpaid Leave', NULL, 0)
+ON DUPLICATE KEY UPDATE code = code;
+
+CREATE TABLE IF NOT EXISTS leave_balances (
+  employee_id int(11) NOT NULL,
+  leave_type varchar(50) NOT NULL,
+  year smallint(6) NOT NULL,
+  entitled decimal(5,1) NOT NULL DEFAULT 0,
+  used decimal(5,1) NOT NULL DEFAULT 0,
+  pending decimal(5,1) NOT NULL DEFAULT 0,
+  updated_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (employee_id, leave_type, year),
+  FOREIGN KEY (employee_id) REFERENCES employees (id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
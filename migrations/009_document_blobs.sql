@@ -0,0 +1,21 @@
+-- Content-addressed document storage. Uploaded files are stored once per distinct content
+-- under UPLOAD_FOLDER/blobs/<aa>/<bb>/<sha256>; documents rows reference them by hash and
+-- document_blobs counts the references. Blobs that drop to zero references are removed by
+-- `flask --app app gc-documents`. Rows uploaded before this migration keep their old
+-- file_path and have no content_hash.
+
+CREATE TABLE IF NOT EXISTS document_blobs (
+  hash char(64) NOT NULL,
+  size_bytes bigint(20) NOT NULL,
+  ref_count int(11) NOT NULL DEFAULT 0,
+  created_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (hash),
+  KEY idx_document_blobs_refs (ref_count)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+ALTER TABLE documents
+  ADD COLUMN content_hash char(64) DEFAULT NULL,
+  ADD COLUMN original_name varchar(255) DEFAULT NULL,
+  ADD COLUMN content_type varchar(100) DEFAULT NULL,
+  ADD COLUMN size_bytes bigint(20) DEFAULT NULL,
+  ADD KEY idx_documents_content_hash (content_hash);
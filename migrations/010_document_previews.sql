@@ -0,0 +1,17 @@
+-- Derivatives of document blobs, built in the background after upload: a small JPEG
+-- thumbnail for images (UPLOAD_FOLDER/blobs/.../<sha256>.thumb.jpg) and the extracted
+-- text of PDFs and text files (<sha256>.txt on disk, searchable copy in document_texts).
+-- Blobs stored before this migration are picked up by `flask --app app build-previews`.
+
+ALTER TABLE document_blobs
+  ADD COLUMN preview_state enum('pending','done','failed') NOT NULL DEFAULT 'pending',
+  ADD COLUMN has_thumbnail tinyint(1) NOT NULL DEFAULT 0,
+  ADD KEY idx_document_blobs_preview_state (preview_state);
+
+CREATE TABLE IF NOT EXISTS document_texts (
+  hash char(64) NOT NULL,
+  content mediumtext NOT NULL,
+  PRIMARY KEY (hash),
+  FULLTEXT KEY ft_document_texts_content (content),
+  FOREIGN KEY (hash) REFERENCES document_blobs (hash) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,9 @@
+-- FULLTEXT indexes behind /admin/search. InnoDB maintains them on every insert and update,
+-- so new documents, reviews and audit entries are searchable as soon as they commit.
+-- Extracted document text is indexed by document_texts (migration 010).
+
+ALTER TABLE documents ADD FULLTEXT KEY ft_documents_title (title, original_name);
+
+ALTER TABLE performance_reviews ADD FULLTEXT KEY ft_performance_reviews_comments (comments);
+
+ALTER TABLE audit_logs ADD FULLTEXT KEY ft_audit_logs_details (action, details);
@@ -0,0 +1,24 @@
+-- Audit log retention. audit_logs keeps the last AUDIT_RETENTION_MONTHS months; older
+-- months are moved by `flask --app app archive-audit-logs` into gzipped JSONL files under
+-- AUDIT_ARCHIVE_FOLDER, one or more per month, listed here. Native partitioning is not
+-- an option because audit_logs.user_id is a foreign key.
+
+CREATE TABLE IF NOT EXISTS audit_archives (
+  id int(11) NOT NULL AUTO_INCREMENT,
+  month char(7) NOT NULL COMMENT 'YYYY-MM',
+  file_name varchar(255) NOT NULL,
+  row_count int(11) NOT NULL,
+  first_id int(11) NOT NULL,
+  last_id int(11) NOT NULL,
+  min_timestamp timestamp NULL DEFAULT NULL,
+  max_timestamp timestamp NULL DEFAULT NULL,
+  archived_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (id),
+  KEY idx_audit_archives_month (month),
+  KEY idx_audit_archives_range (max_timestamp, min_timestamp)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Filtered time-range queries over the hot table
+ALTER TABLE audit_logs
+  ADD KEY idx_audit_user_time (user_id, timestamp),
+  ADD KEY idx_audit_action_time (action, timestamp);